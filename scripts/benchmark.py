@@ -0,0 +1,203 @@
+#!/usr/bin/python
+# coding: utf-8
+
+# maposmatic, the web front-end of the MapOSMatic city map generation system
+# Copyright (C) 2009  David Decotigny
+# Copyright (C) 2009  Frédéric Lehobey
+# Copyright (C) 2009  David Mentré
+# Copyright (C) 2009  Maxime Petazzoni
+# Copyright (C) 2009  Thomas Petazzoni
+# Copyright (C) 2009  Gaël Utard
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Rendering throughput benchmark. Copies of a template job are queued and
+# rendered by a pool of workers, for each of the given worker counts, and the
+# resulting throughput is reported in jobs per hour.
+#
+# With --pages, a copy of each of the given multi_page template jobs, for
+# example 10, 40 and 100 page ones, is rendered on its own through the normal
+# renderer, and its wall-clock rendering time is reported along with its
+# number of pages and the time spent in the main rendering stages. This is
+# the baseline the rendering of multi_page jobs has to be compared with.
+#
+# Only the benchmark jobs are rendered, but they go through the real rendering
+# pipeline: run this against a staging instance, not a production one.
+
+import os
+import re
+import sys
+import time
+
+import daemon
+import render
+from www.maposmatic import helpers
+from www.maposmatic.models import MapRenderingJob
+
+BENCHMARK_TITLE = 'MapOSMatic benchmark'
+
+class BenchmarkDaemon(daemon.PoolingMapOSMaticDaemon):
+    """
+    A pooling daemon that only renders the given benchmark jobs, and leaves
+    the rest of the queue alone.
+    """
+
+    def __init__(self, jobids, workers):
+        self.jobids = jobids
+        daemon.PoolingMapOSMaticDaemon.__init__(self, workers)
+
+    def rollback_orphaned_jobs(self):
+        pass
+
+    def queue(self):
+        return (daemon.PoolingMapOSMaticDaemon.queue(self)
+                .filter(id__in=self.jobids))
+
+def queue_copies(template, count):
+    """Queue count copies of the template job, and return their IDs."""
+
+    jobids = []
+    for i in range(count):
+        job = MapRenderingJob.objects.get(id=template.id)
+        job.id = None
+        job.maptitle = '%s %d' % (BENCHMARK_TITLE, i)
+        job.status = 0
+        job.startofrendering_time = None
+        job.endofrendering_time = None
+        job.resultmsg = None
+        job.index_queue_at_submission = 0
+        job.nonce = helpers.generate_nonce(MapRenderingJob.NONCE_SIZE)
+        job.save()
+        jobids.append(job.id)
+    return jobids
+
+def count_pages(path):
+    """Returns the number of pages of the given PDF file."""
+    with open(path) as f:
+        return len(re.findall(r'/Type\s*/Page[^s]', f.read()))
+
+def run_single(template):
+    """Render a copy of the template job. Returns the rendering result, the
+    number of pages of the PDF file, the elapsed time, in seconds, and the
+    rendering stage timings."""
+
+    job = MapRenderingJob.objects.get(id=queue_copies(template, 1)[0])
+    try:
+        job.start_rendering(BENCHMARK_TITLE)
+        renderer = render.JobRenderer(job, 'benchmark_%d_' % os.getpid())
+        start = time.time()
+        result = renderer.run()
+        elapsed = time.time() - start
+
+        pages = 0
+        if result == render.RESULT_SUCCESS and os.path.exists(
+                job.get_map_filepath('pdf')):
+            pages = count_pages(job.get_map_filepath('pdf'))
+        return result, pages, elapsed, renderer.timings
+    finally:
+        render.remove_cancelled_files(job)
+        job.delete()
+
+def pages_benchmark(templates):
+    print '%8s %8s %10s %10s %10s %10s' % ('job', 'pages', 'time (s)',
+                                           'prep. (s)', 'render (s)',
+                                           's/page')
+
+    for template in templates:
+        if template.layout != 'multi_page':
+            print '%8d not a multi_page job (%s)' % (template.id,
+                                                     template.layout)
+            continue
+
+        result, pages, elapsed, timings = run_single(template)
+        if result != render.RESULT_SUCCESS:
+            print '%8d rendering failed (result %d)' % (template.id, result)
+            continue
+
+        preparation = sum([seconds for stage, seconds in timings
+                           if stage == 'preparation'])
+        rendering = sum([seconds for stage, seconds in timings
+                         if stage.startswith('render.')])
+        print '%8d %8d %10.1f %10.1f %10.1f %10.2f' % \
+            (template.id, pages, elapsed, preparation, rendering,
+             pages and elapsed / pages or 0)
+
+def run(template, count, workers):
+    """Render count copies of the template job with the given number of
+    workers. Returns the number of successful renderings and the elapsed
+    time, in seconds."""
+
+    jobids = queue_copies(template, count)
+    try:
+        start = time.time()
+        BenchmarkDaemon(jobids, workers).serve(drain=True)
+        elapsed = time.time() - start
+
+        jobs = MapRenderingJob.objects.filter(id__in=jobids)
+        return jobs.filter(resultmsg='ok').count(), elapsed
+    finally:
+        for job in MapRenderingJob.objects.filter(id__in=jobids):
+            if job.startofrendering_time:
+                job.remove_all_files()
+            job.delete()
+
+if __name__ == '__main__':
+    def usage():
+        sys.stderr.write('usage: %s <template jobid> <jobs> <workers,...>\n'
+                         '       %s --pages <template jobid,...>\n'
+                         % (sys.argv[0], sys.argv[0]))
+
+    if len(sys.argv) == 3 and sys.argv[1] == '--pages':
+        try:
+            templates = [MapRenderingJob.objects.get(id=int(jobid))
+                         for jobid in sys.argv[2].split(',')]
+        except ValueError:
+            usage()
+            sys.exit(3)
+        except MapRenderingJob.DoesNotExist:
+            sys.stderr.write('Job not found!\n')
+            sys.exit(4)
+
+        pages_benchmark(templates)
+        sys.exit(0)
+
+    if len(sys.argv) != 4:
+        usage()
+        sys.exit(3)
+
+    try:
+        template = MapRenderingJob.objects.get(id=int(sys.argv[1]))
+        count = int(sys.argv[2])
+        pools = map(int, sys.argv[3].split(','))
+    except ValueError:
+        usage()
+        sys.exit(3)
+    except MapRenderingJob.DoesNotExist:
+        sys.stderr.write('Job #%s not found!\n' % sys.argv[1])
+        sys.exit(4)
+
+    print 'Rendering %d copies of job #%d (%s, %s, %dx%d mm).' % \
+        (count, template.id, template.layout, template.stylesheet,
+         template.paper_width_mm, template.paper_height_mm)
+    print '%8s %8s %10s %10s %8s' % ('workers', 'ok', 'time (s)',
+                                     'jobs/hour', 'speedup')
+
+    reference = None
+    for workers in pools:
+        ok, elapsed = run(template, count, workers)
+        throughput = ok * 3600.0 / elapsed
+        reference = reference or throughput
+        print '%8d %8d %10.1f %10.1f %7.2fx' % \
+            (workers, ok, elapsed, throughput,
+             reference and throughput / reference or 0)
@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# coding: utf-8
+
+# maposmatic, the web front-end of the MapOSMatic city map generation system
+# Copyright (C) 2009  David Decotigny
+# Copyright (C) 2009  Frédéric Lehobey
+# Copyright (C) 2009  David Mentré
+# Copyright (C) 2009  Maxime Petazzoni
+# Copyright (C) 2009  Thomas Petazzoni
+# Copyright (C) 2009  Gaël Utard
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Cold tier of the renderings. Renderings older than RENDERING_COLD_AGE_DAYS
+# are demoted by a thread of the rendering daemon: their files are
+# recompressed in place, to keep more of them within
+# RENDERING_RESULT_MAX_SIZE_GB before they have to be removed. PNG maps are
+# optimized (and quantized to RENDERING_COLD_PNG_COLORS colors, if set), PDF
+# maps are rewritten by Ghostscript, and CSV indexes are gzipped; the web
+# front-end serves the gzipped indexes uncompressed. A recompressed file is
+# only kept when it's smaller, and keeps the modification time of the
+# original file, that is its age for the garbage collector.
+#
+# Files shared with other jobs through hard links are left alone, since
+# rewriting them would only duplicate them.
+
+import gzip
+import Image
+import logging
+import os
+import shutil
+import subprocess
+
+from www.maposmatic.models import RenderingFile
+from www.settings import RENDERING_RESULT_PATH, RENDERING_COLD_PNG_COLORS
+
+l = logging.getLogger('maposmatic')
+
+GS_COMMAND = ['gs', '-q', '-dBATCH', '-dNOPAUSE', '-dSAFER',
+              '-sDEVICE=pdfwrite', '-dPDFSETTINGS=/printer']
+
+def _temporary_path(path):
+    # Dot files are ignored by the garbage collector.
+    return os.path.join(os.path.dirname(path),
+                        '.cold-' + os.path.basename(path))
+
+def _compress_png(path, tmp):
+    img = Image.open(path)
+    if RENDERING_COLD_PNG_COLORS:
+        img = img.convert('RGB').convert('P', palette=Image.ADAPTIVE,
+                                         colors=RENDERING_COLD_PNG_COLORS)
+    img.save(tmp, 'PNG', optimize=True)
+
+def _compress_pdf(path, tmp):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(GS_COMMAND + ['-sOutputFile=%s' % tmp, path],
+                              stdout=devnull, stderr=devnull)
+
+def _compress_csv(path, tmp):
+    with open(path, 'rb') as f:
+        out = gzip.open(tmp, 'wb')
+        try:
+            shutil.copyfileobj(f, out)
+        finally:
+            out.close()
+
+# The compression function and the extension of the compressed file, by
+# format.
+COMPRESSORS = {
+    'png': (_compress_png, ''),
+    'pdf': (_compress_pdf, ''),
+    'csv': (_compress_csv, '.gz'),
+}
+
+def compress(path):
+    """Recompress the given rendering file in place, when that makes it
+    smaller.
+
+    Returns the path of the file, that changes when its extension does, and
+    the number of bytes saved."""
+
+    format = os.path.splitext(path)[1][1:]
+    if format not in COMPRESSORS:
+        return path, 0
+
+    s = os.stat(path)
+    if s.st_nlink > 1:
+        return path, 0
+
+    compressor, extension = COMPRESSORS[format]
+    tmp = _temporary_path(path + extension)
+    try:
+        compressor(path, tmp)
+        saved = s.st_size - os.stat(tmp).st_size
+        if saved <= 0:
+            os.remove(tmp)
+            return path, 0
+
+        os.utime(tmp, (s.st_atime, s.st_mtime))
+        os.rename(tmp, path + extension)
+        if extension:
+            os.remove(path)
+        return path + extension, saved
+    except Exception, e:
+        l.warning("Could not compress %s: %s" % (path, e))
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return path, 0
+
+def demote(job):
+    """Move the rendering of the given job to the cold tier, recompressing
+    its indexed files.
+
+    Returns the number of bytes saved."""
+
+    saved = 0
+    for f in RenderingFile.objects.filter(job=job, cold=False):
+        try:
+            path, file_saved = compress(os.path.join(RENDERING_RESULT_PATH,
+                                                     f.name))
+            if os.path.basename(path) != f.name:
+                RenderingFile.objects.remove(f.name)
+            RenderingFile.objects.add(path, job, cold=True)
+            saved += file_saved
+        except OSError:
+            # Removed by the garbage collector in the mean time.
+            continue
+    return saved
@@ -23,29 +23,295 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import multiprocessing
 import os
+import socket
 import sys
 import threading
 import time
+from datetime import datetime
 
+from django.db import connection, transaction
+
+import coldstorage
+import inotify
+import metrics
 import render
-from www.maposmatic.models import MapRenderingJob
+from www.maposmatic import estimate, gisdb, rendercache, wakeup
+from www.maposmatic.models import MapRenderingJob, RenderingDurationStats
+from www.maposmatic.models import RenderingDaemon, RenderingFile
 from www.settings import RENDERING_RESULT_PATH, RENDERING_RESULT_MAX_SIZE_GB
+from www.settings import RENDERING_RESULT_HIGH_WATERMARK
+from www.settings import RENDERING_RESULT_LOW_WATERMARK
+from www.settings import RENDERING_COLD_AGE_DAYS
+from www.settings import DAEMON_WORKERS, DAEMON_WARM_WORKERS
+from www.settings import DAEMON_WORKERS_MIN, DAEMON_TUNING_MAX_LOAD
+from www.settings import DAEMON_TUNING_MIN_AVAILABLE_MB
+from www.settings import DAEMON_TUNING_MAX_GIS_LATENCY
+from www.settings import DAEMON_LEASE_DURATION
+from www.settings import DAEMON_LARGE_JOB_MEMORY_LIMIT_MB
+from www.settings import DAEMON_METRICS_ADDRESS, DAEMON_METRICS_PORT
 
 _DEFAULT_CLEAN_FREQUENCY = 20       # Clean thread polling frequency, in
+                                    # seconds, when inotify is not
+                                    # available.
+_DEFAULT_RECONCILE_FREQUENCY = 3600 # Renderings index reconciliation
+                                    # frequency, in seconds.
+_DEFAULT_POLL_FREQUENCY = 60        # Daemon job polling frequency, in
+                                    # seconds, when no wakeup notification
+                                    # is received.
+_DEMOTION_FREQUENCY = 3600          # Cold tier demotion frequency, in
                                     # seconds.
-_DEFAULT_POLL_FREQUENCY = 10        # Daemon job polling frequency, in seconds
+_DEMOTION_BATCH_SIZE = 50           # Maximum number of renderings moved to
+                                    # the cold tier at each demotion.
+_EVICTION_BATCH_SIZE = 100          # Number of the oldest renderings files
+                                    # considered at once by the cleanup.
+_TUNING_FREQUENCY = 30              # Rendering workers concurrency tuning
+                                    # frequency, in seconds.
 
 _RESULT_MSGS = {
     render.RESULT_SUCCESS: 'ok',
     render.RESULT_KEYBOARD_INTERRUPT: 'rendering interrupted',
     render.RESULT_PREPARATION_EXCEPTION: 'data preparation failed',
     render.RESULT_RENDERING_EXCEPTION: 'rendering failed',
-    render.RESULT_TIMEOUT_REACHED: 'rendering took too long, canceled'
+    render.RESULT_TIMEOUT_REACHED: 'rendering took too long, canceled',
+    render.RESULT_CANCELLED: 'rendering cancelled',
+    render.RESULT_MEMORY_EXCEEDED: 'not enough memory'
 }
 
+QUEUE_SIZE = metrics.Gauge('maposmatic_queue_size',
+    'Number of jobs waiting to be rendered.',
+    function=lambda: MapRenderingJob.objects.queue_size())
+QUEUE_WAIT = metrics.Histogram('maposmatic_queue_wait_seconds',
+    'Time spent by the jobs in the queue.', ('layout', 'stylesheet'))
+RENDER_DURATION = metrics.Histogram('maposmatic_render_duration_seconds',
+    'Rendering time of the jobs.', ('layout', 'stylesheet'))
+THUMBNAIL_DURATION = metrics.Histogram(
+    'maposmatic_thumbnail_duration_seconds',
+    'Thumbnail creation time of the jobs.', ('layout',),
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60))
+RESULTS = metrics.Counter('maposmatic_jobs_total',
+    'Number of rendered jobs, by result.', ('result',))
+GC_RECLAIMED = metrics.Counter('maposmatic_gc_reclaimed_bytes_total',
+    'Disk space reclaimed by the renderings garbage collector.')
+COALESCED = metrics.Counter('maposmatic_coalesced_jobs_total',
+    'Number of jobs served by the rendering of an identical job.')
+WORKER_TIME = metrics.Counter('maposmatic_worker_seconds_total',
+    'Time spent by the rendering workers, busy rendering, idle or inactive.',
+    ('worker', 'state'))
+ACTIVE_WORKERS = metrics.Gauge('maposmatic_active_workers',
+    'Number of rendering workers allowed to render jobs.')
+SCALING = metrics.Counter('maposmatic_scaling_decisions_total',
+    'Number of changes of the number of active rendering workers.',
+    ('direction',))
+
 l = logging.getLogger('maposmatic')
 
+class WakeupListener(threading.Thread):
+    """
+    A thread listening for the wakeup notifications sent by the web front-end
+    when a job is queued, and waking up the rendering workers waiting for
+    jobs.
+
+    Each notification increments the generation counter. Workers read it
+    before looking for a job, and pass it to wait(), so that a notification
+    received in between is not lost.
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='wakeup')
+        self.setDaemon(True)
+        self.generation = 0
+        self.__condition = threading.Condition()
+
+    def run(self):
+        listener = wakeup.Listener()
+        while True:
+            if listener.wait(_DEFAULT_POLL_FREQUENCY):
+                l.debug("Wakeup notification received.")
+                self.wake()
+
+    def wake(self):
+        """Wake up all the workers waiting for jobs."""
+        self.__condition.acquire()
+        try:
+            self.generation += 1
+            self.__condition.notifyAll()
+        finally:
+            self.__condition.release()
+
+    def wait(self, since, timeout):
+        """Wait for at most timeout seconds, unless a notification was
+        received since the given generation."""
+        self.__condition.acquire()
+        try:
+            if self.generation == since:
+                self.__condition.wait(timeout)
+        finally:
+            self.__condition.release()
+
+class LeaseKeeper(threading.Thread):
+    """
+    A thread renewing the leases of the jobs rendered by this daemon, and
+    putting back in the queue the jobs whose lease expired, wherever they
+    were rendered. Leases are renewed several times per lease duration, so
+    that a slow database doesn't make them expire. The number of active
+    rendering workers of the daemon, given by get_workers(), is recorded
+    along, for the queue estimates of the web front-end.
+
+    Only the leases of the jobs actually in flight are renewed: the daemon
+    holds() the jobs it claims, and releases() them once it's done with them,
+    whatever happened to their rendering.
+    """
+
+    def __init__(self, worker, get_workers):
+        threading.Thread.__init__(self, name='leases')
+        self.setDaemon(True)
+        self.worker = worker
+        self.get_workers = get_workers
+        self.frequency = DAEMON_LEASE_DURATION / 4.0
+        self.__jobids = set()
+        self.__lock = threading.Lock()
+
+    def hold(self, *jobids):
+        """Renew the leases of the given jobs until they're released."""
+        self.__lock.acquire()
+        try:
+            self.__jobids.update(jobids)
+        finally:
+            self.__lock.release()
+
+    def release(self, *jobids):
+        """Stop renewing the leases of the given jobs."""
+        self.__lock.acquire()
+        try:
+            self.__jobids.difference_update(jobids)
+        finally:
+            self.__lock.release()
+
+    def get_held(self):
+        """Returns the IDs of the jobs whose leases are renewed."""
+        self.__lock.acquire()
+        try:
+            return list(self.__jobids)
+        finally:
+            self.__lock.release()
+
+    def run(self):
+        while True:
+            time.sleep(self.frequency)
+            try:
+                MapRenderingJob.objects.renew_leases(self.worker,
+                                                     self.get_held())
+                RenderingDaemon.objects.heartbeat(self.worker,
+                                                  self.get_workers())
+                reaped = MapRenderingJob.objects.reap_expired_leases()
+                if reaped:
+                    l.warning("Put %d job(s) with an expired lease back in "
+                              "the queue." % reaped)
+            except Exception:
+                l.exception("Could not renew the job leases!")
+
+class ConcurrencyTuner(threading.Thread):
+    """
+    A thread tuning the number of active rendering workers of a pooling
+    daemon between minimum and maximum. Every frequency seconds, one worker
+    is deactivated when the host is overloaded (load average, available
+    memory or PostGIS latency), or one is activated when jobs are waiting and
+    the host has room for more.
+    """
+
+    def __init__(self, minimum, maximum, frequency=_TUNING_FREQUENCY):
+        threading.Thread.__init__(self, name='tuning')
+        self.setDaemon(True)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.frequency = frequency
+        self.active = minimum
+        ACTIVE_WORKERS.set(self.active)
+
+    def get_load(self):
+        """Returns the 1 minute load average, per CPU."""
+        return os.getloadavg()[0] / multiprocessing.cpu_count()
+
+    def get_available_memory(self):
+        """Returns the memory available for new processes, in MiB, or None
+        if unknown."""
+        try:
+            with open('/proc/meminfo') as f:
+                for line in f:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) / 1024
+        except (IOError, ValueError, IndexError):
+            pass
+        return None
+
+    def get_gis_latency(self):
+        """Returns the time taken by a trivial PostGIS query, in seconds, or
+        None if the GIS database is not available."""
+        db = gisdb.get()
+        if db is None:
+            return None
+
+        start = time.time()
+        cursor = db.cursor()
+        try:
+            cursor.execute('select 1')
+            cursor.fetchone()
+        finally:
+            cursor.close()
+            db.rollback()
+        return time.time() - start
+
+    def tune(self):
+        """Returns the new number of active workers, the direction of the
+        change ('up', 'down' or None) and its reason."""
+
+        load = self.get_load()
+        memory = self.get_available_memory()
+        latency = self.get_gis_latency()
+
+        pressure = []
+        if load > DAEMON_TUNING_MAX_LOAD:
+            pressure.append('load %.2f per CPU' % load)
+        if memory is not None and memory < DAEMON_TUNING_MIN_AVAILABLE_MB:
+            pressure.append('%d MiB available' % memory)
+        if latency is not None and latency > DAEMON_TUNING_MAX_GIS_LATENCY:
+            pressure.append('PostGIS latency %.3fs' % latency)
+
+        if pressure:
+            if self.active > self.minimum:
+                return self.active - 1, 'down', ', '.join(pressure)
+            return self.active, None, None
+
+        # Leave some headroom, so that the number of workers doesn't go up
+        # and down all the time.
+        queued = MapRenderingJob.objects.queue_size()
+        if (queued and self.active < self.maximum and
+            load < 0.75 * DAEMON_TUNING_MAX_LOAD):
+            return (self.active + 1, 'up',
+                    '%d job(s) waiting, load %.2f per CPU' % (queued, load))
+        return self.active, None, None
+
+    def run(self):
+        l.info("Tuning the number of active rendering workers between %d and "
+               "%d." % (self.minimum, self.maximum))
+
+        while True:
+            time.sleep(self.frequency)
+            try:
+                active, direction, reason = self.tune()
+            except Exception:
+                l.exception("Could not tune the number of rendering workers!")
+                continue
+
+            if direction:
+                l.info("Scaling %s to %d active rendering worker(s) (%s)." %
+                       (direction, active, reason))
+                SCALING.inc(direction=direction)
+                self.active = active
+                ACTIVE_WORKERS.set(active)
+
 class MapOSMaticDaemon:
     """
     This is a basic rendering daemon, base class for the different
@@ -58,32 +324,129 @@ class MapOSMaticDaemon:
 
     def __init__(self, frequency=_DEFAULT_POLL_FREQUENCY):
         self.frequency = frequency
-        l.info("MapOSMatic rendering daemon started.")
+        self.worker = '%s:%d' % (socket.gethostname(), os.getpid())
+        l.info("MapOSMatic rendering daemon started (%s)." % self.worker)
         self.rollback_orphaned_jobs()
 
+        self.leases = LeaseKeeper(self.worker, self.get_active_workers)
+        self.leases.start()
+
+        self.wakeup = WakeupListener()
+        self.wakeup.start()
+
+        # Large jobs, that went over the regular memory limit, are rendered
+        # one at a time.
+        self.large_lane = threading.Semaphore(1)
+
+    def get_active_workers(self):
+        """Returns the number of rendering workers of this daemon allowed
+        to render jobs."""
+        return 1
+
     def rollback_orphaned_jobs(self):
-        """Reset all jobs left in the "rendering" state back to the "waiting"
-        state to process them correctly."""
-        MapRenderingJob.objects.filter(status=1).update(status=0)
+        """Reset the jobs left in the "rendering" state by dead workers back to
+        the "waiting" state to process them correctly. Jobs being rendered by
+        other live daemons, possibly on other hosts, hold a valid lease and
+        are left alone."""
+        MapRenderingJob.objects.reap_expired_leases()
 
     def serve(self):
-        """Implement a basic service loop, looking every self.frequency seconds
-        for a new job to render and dispatch it if one's available. This method
+        """Implement a basic service loop, looking for a new job to render
+        whenever the web front-end notifies a new job was queued, or every
+        self.frequency seconds, and dispatch it if one's available. This method
         can of course be overloaded by subclasses of MapOSMaticDaemon depending
         on their needs."""
 
         while True:
+            job = None
             try:
-                job = MapRenderingJob.objects.to_render()[0]
-                self.dispatch(job)
-            except IndexError:
-                try:
-                    time.sleep(self.frequency)
-                except KeyboardInterrupt:
-                    break
+                since = self.wakeup.generation
+                job = self.next_job()
+                if job:
+                    start = time.time()
+                    self.dispatch(job)
+                    WORKER_TIME.inc(time.time() - start, worker=0,
+                                    state='busy')
+                    continue
+
+                start = time.time()
+                self.wakeup.wait(since, self.frequency)
+                WORKER_TIME.inc(time.time() - start, worker=0, state='idle')
+            except KeyboardInterrupt:
+                break
+            except Exception:
+                l.exception("Rendering daemon failed%s!" %
+                            (job and ' on job #%d' % job.id or ''))
+                self.recover(job)
+                time.sleep(1)
 
         l.info("MapOSMatic rendering daemon terminating.")
 
+    def recover(self, job=None):
+        """Clean up after an unexpected error while looking for a job or
+        rendering the given job: roll the thread's database connection back,
+        and end the job as failed if it's still ours. Its files are only
+        removed then: the error may have happened after the job was ended and
+        its files published. The identical jobs it was serving go back in the
+        queue once their lease expires."""
+
+        try:
+            transaction.rollback_unless_managed()
+        except Exception:
+            # The connection is dead, get a new one next time.
+            connection.close()
+
+        if job is None:
+            return
+
+        try:
+            ret = render.RESULT_RENDERING_EXCEPTION
+            ended = (MapRenderingJob.objects
+                     .filter(id=job.id, status=1, rendering_worker=self.worker)
+                     .update(status=2, endofrendering_time=datetime.now(),
+                             resultmsg=_RESULT_MSGS[ret]))
+            if ended:
+                render.remove_cancelled_files(job)
+                RenderingFile.objects.remove_job(job)
+                RESULTS.inc(result=_RESULT_MSGS[ret])
+        except Exception:
+            l.exception("Could not end job #%d!" % job.id)
+
+    def queue(self):
+        """Returns the queue of jobs this daemon renders. See
+        MapRenderingJobManager.schedule() for the order in which they are
+        rendered."""
+        return MapRenderingJob.objects.to_render()
+
+    def next_job(self):
+        """Claim the next job to render from the queue. The jobs of the
+        scheduled queue are tried in order until one of them can be claimed,
+        since other workers may be claiming jobs at the same time. If they
+        all were claimed by other workers, the queue is looked at again for
+        the jobs queued in the mean time.
+
+        Returns the claimed job, or None if the queue is empty, or only holds
+        large jobs while a large job is already being rendered."""
+
+        while True:
+            contended = False
+            for job in MapRenderingJob.objects.schedule(self.queue()):
+                if job.large and not self.large_lane.acquire(False):
+                    continue
+                try:
+                    if job.start_rendering(self.worker):
+                        self.leases.hold(job.id)
+                        return job
+                except Exception:
+                    if job.large:
+                        self.large_lane.release()
+                    raise
+                if job.large:
+                    self.large_lane.release()
+                contended = True
+            if not contended:
+                return None
+
     def dispatch(self, job):
         """In this simple single-process daemon, dispatching is as easy as
         calling the render() method. Subclasses probably want to overload this
@@ -98,23 +461,142 @@ class MapOSMaticDaemon:
         return self.render(job, 'maposmaticd_%d_' % os.getpid())
 
     def render(self, job, prefix=None):
-        """Render a given job. Uses get_renderer() to get the appropriate
-        renderer to use to render this job.
+        """Render a given job, previously claimed with next_job(). Uses
+        get_renderer() to get the appropriate renderer to use to render this
+        job.
 
         Args:
             job (MapRenderingJob): the job to process and render.
-            renderer (JobRenderer): the renderer to use.
+            prefix (string): renderer map_areas table prefix.
 
         Returns True if the rendering was successful, False otherwise.
         """
+        large = job.large
+        try:
+            return self._render(job, prefix)
+        finally:
+            self.leases.release(job.id)
+            if large:
+                self.large_lane.release()
+
+    def _render(self, job, prefix):
+        waited = job.startofrendering_time - job.submission_time
+        QUEUE_WAIT.observe(waited.days * 86400 + waited.seconds,
+                           layout=job.layout, stylesheet=job.stylesheet)
+
+        job.set_render_timeout(estimate.estimate_timeout(job))
+        l.info("Rendering job #%d with a %ds timeout." %
+               (job.id, job.render_timeout))
+
+        attached = self.coalesce(job)
+        try:
+            return self._render_coalesced(job, prefix, attached)
+        finally:
+            self.leases.release(*[other.id for other in attached])
+
+    def _render_coalesced(self, job, prefix, attached):
+        # Renderings are keyed on the GIS data version at the start of the
+        # rendering, to be reused by identical jobs submitted later on.
+        key = rendercache.get_key(job)
+        if key:
+            for j in [job] + attached:
+                j.set_render_key(key)
+
+        start = time.time()
         renderer = self.get_renderer(job, prefix)
-        job.start_rendering()
         ret = renderer.run()
-        job.end_rendering(_RESULT_MSGS[ret])
+        duration = time.time() - start
+        RENDER_DURATION.observe(duration, layout=job.layout,
+                                stylesheet=job.stylesheet)
+        RESULTS.inc(result=_RESULT_MSGS[ret])
+
+        if ret == render.RESULT_CANCELLED:
+            # The job entry was updated when the job was cancelled, and the
+            # identical jobs it was serving go back in the queue.
+            for other in attached:
+                other.requeue()
+            return False
+
+        if (ret == render.RESULT_MEMORY_EXCEEDED and
+            DAEMON_LARGE_JOB_MEMORY_LIMIT_MB and not job.large):
+            l.info("Job #%d went over the memory limit, it will be rendered "
+                   "again as a large job." % job.id)
+            for j in [job] + attached:
+                j.large = True
+                j.requeue()
+            return False
+
+        ended = job.end_rendering(_RESULT_MSGS[ret])
+        if not ended:
+            l.warning("Lost the lease on job #%d, result only published for "
+                      "the identical jobs it serves." % job.id)
+        else:
+            job.record_timings(renderer.timings)
+            if renderer.usage:
+                job.record_usage(renderer.usage)
+            for stage, seconds in renderer.timings:
+                if stage == 'thumbnail':
+                    THUMBNAIL_DURATION.observe(seconds, layout=job.layout)
+            if ret == render.RESULT_SUCCESS:
+                RenderingDurationStats.objects.record(job, duration)
+                RenderingFile.objects.add_job(job)
+
+        for other in attached:
+            self.publish_coalesced(job, other, ret)
+
+        if not ended:
+            # The files of a job cancelled while it was ending are removed
+            # once the identical jobs have their own links to them. Those of
+            # a job put back in the queue are replaced by its next rendering.
+            if job.was_cancelled():
+                render.remove_cancelled_files(job)
+                RenderingFile.objects.remove_job(job)
+            return False
         return ret == 0
 
+    def coalesce(self, job):
+        """Claim the waiting jobs identical to the given job, so that they're
+        served by its rendering.
+
+        Returns the list of claimed jobs."""
+
+        attached = []
+        for other in MapRenderingJob.objects.get_identical(job):
+            if other.start_rendering(self.worker):
+                self.leases.hold(other.id)
+                attached.append(other)
+        if attached:
+            COALESCED.inc(len(attached))
+            l.info("Job #%d will also serve identical job(s) %s." %
+                   (job.id, ', '.join(['#%d' % o.id for o in attached])))
+        return attached
+
+    def publish_coalesced(self, job, other, ret):
+        """Publish the result of the rendering of the given job for the
+        identical job other, unless other was cancelled in the mean time."""
+
+        if ret == render.RESULT_SUCCESS:
+            try:
+                other.link_files(job)
+            except OSError:
+                l.exception("Could not publish the files of job #%d for "
+                            "job #%d!" % (job.id, other.id))
+                render.remove_cancelled_files(other)
+                ret = render.RESULT_RENDERING_EXCEPTION
+
+        if not other.end_rendering(_RESULT_MSGS[ret]):
+            l.info("Job #%d was cancelled, the rendering of job #%d is not "
+                   "published for it." % (other.id, job.id))
+            if ret == render.RESULT_SUCCESS:
+                render.remove_cancelled_files(other)
+                RenderingFile.objects.remove_job(other)
+            return
+
+        RESULTS.inc(result=_RESULT_MSGS[ret])
+
     def get_renderer(self, job, prefix):
-        return render.ThreadingJobRenderer(job, prefix=prefix)
+        return render.ThreadingJobRenderer(job, job.render_timeout,
+                                           prefix=prefix)
 
 class ForkingMapOSMaticDaemon(MapOSMaticDaemon):
 
@@ -123,47 +605,286 @@ class ForkingMapOSMaticDaemon(MapOSMaticDaemon):
         l.info('This is the forking daemon. Will fork to process each job.')
 
     def get_renderer(self, job, prefix):
-        return render.ForkingJobRenderer(job, prefix=prefix)
+        return render.ForkingJobRenderer(job, job.render_timeout,
+                                         prefix=prefix)
+
+class PoolingMapOSMaticDaemon(ForkingMapOSMaticDaemon):
+    """
+    A multi-worker rendering daemon. It runs a pool of worker threads, each of
+    them claiming jobs from the queue and rendering them in a forked process,
+    so that up to `workers` jobs are rendered at the same time. Jobs are
+    claimed atomically (see MapRenderingJob.start_rendering()), so two
+    workers never render the same job.
+    """
+
+    def __init__(self, workers=DAEMON_WORKERS,
+                 frequency=_DEFAULT_POLL_FREQUENCY):
+        ForkingMapOSMaticDaemon.__init__(self, frequency)
+        self.workers = workers
+        self.tuner = None
+        self._stopping = threading.Event()
+        l.info('Running a pool of %d rendering workers.' % workers)
+
+    def serve(self, drain=False):
+        """Start the worker threads and wait for them to terminate, which only
+        happens when the daemon is interrupted, or when the queue is empty if
+        drain is True."""
+
+        if DAEMON_WORKERS_MIN and DAEMON_WORKERS_MIN < self.workers and \
+                not drain:
+            self.tuner = ConcurrencyTuner(DAEMON_WORKERS_MIN, self.workers)
+            self.tuner.start()
+
+        threads = []
+        for wid in range(self.workers):
+            t = threading.Thread(target=self._work, args=(wid, drain),
+                                 name='worker-%d' % wid)
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+
+        try:
+            while filter(lambda t: t.isAlive(), threads):
+                time.sleep(1)
+        except KeyboardInterrupt:
+            l.info("Waiting for the rendering workers to terminate...")
+            self._stopping.set()
+            self.wakeup.wake()
+            for t in threads:
+                t.join()
+
+        l.info("MapOSMatic rendering daemon terminating.")
+
+    def get_active_workers(self):
+        if self.tuner:
+            return self.tuner.active
+        return self.workers
+
+    def get_prefix(self, wid):
+        """Returns the renderer map_areas table prefix of worker wid."""
+        return 'maposmaticd_%d_%d_' % (os.getpid(), wid)
+
+    def _work(self, wid, drain):
+        """Main loop of the worker thread number wid."""
+
+        prefix = self.get_prefix(wid)
+        l.debug("Rendering worker #%d started." % wid)
+
+        while not self._stopping.isSet():
+            if self.tuner and wid >= self.tuner.active:
+                start = time.time()
+                self._stopping.wait(1)
+                WORKER_TIME.inc(time.time() - start, worker=wid,
+                                state='inactive')
+                continue
+
+            job = None
+            try:
+                since = self.wakeup.generation
+                job = self.next_job()
+                if job:
+                    l.info("Worker #%d picked job #%d." % (wid, job.id))
+                    start = time.time()
+                    self.render(job, prefix)
+                    WORKER_TIME.inc(time.time() - start, worker=wid,
+                                    state='busy')
+                elif drain:
+                    break
+                else:
+                    start = time.time()
+                    self.wakeup.wait(since, self.frequency)
+                    WORKER_TIME.inc(time.time() - start, worker=wid,
+                                    state='idle')
+            except Exception:
+                # Keep the worker running, the pool would shrink otherwise.
+                l.exception("Rendering worker #%d failed%s!" %
+                            (wid, job and ' on job #%d' % job.id or ''))
+                self.recover(job)
+                self._stopping.wait(1)
+
+        l.debug("Rendering worker #%d terminated." % wid)
+
+class PreforkingMapOSMaticDaemon(PoolingMapOSMaticDaemon):
+    """
+    A pooling daemon where each worker renders its jobs in a long-lived,
+    pre-forked rendering process (see render.RenderingWorker), to avoid
+    setting up a new renderer for each job.
+    """
+
+    def __init__(self, workers=DAEMON_WORKERS,
+                 frequency=_DEFAULT_POLL_FREQUENCY):
+        PoolingMapOSMaticDaemon.__init__(self, workers, frequency)
+        self.__workers = {}
+        l.info('Rendering workers are pre-forked and reused across jobs.')
+
+    def serve(self, drain=False):
+        for wid in range(self.workers):
+            prefix = self.get_prefix(wid)
+            self.__workers[prefix] = render.RenderingWorker(prefix)
+            self.__workers[prefix].start()
+
+        try:
+            PoolingMapOSMaticDaemon.serve(self, drain)
+        finally:
+            for worker in self.__workers.values():
+                worker.stop()
+
+    def get_renderer(self, job, prefix):
+        return render.WarmJobRenderer(job, self.__workers[prefix],
+                                      job.render_timeout, prefix=prefix)
 
 class RenderingsGarbageCollector(threading.Thread):
     """
     A garbage collector thread that removes old rendering from
-    RENDERING_RESULT_PATH when the total size of the directory goes about 80%
-    of RENDERING_RESULT_MAX_SIZE_GB.
+    RENDERING_RESULT_PATH when the total size of the directory goes above the
+    high watermark, until it's back below the low watermark (see
+    RENDERING_RESULT_HIGH_WATERMARK and RENDERING_RESULT_LOW_WATERMARK).
+
+    The directory is watched with inotify, and a running total of its size is
+    updated as files are added and removed, so that nothing is done while the
+    directory doesn't change. Without inotify, the size is read from the
+    renderings index every frequency seconds.
+
+    The age of the files is read from the renderings index (see
+    RenderingFile), which is reconciled with the directory contents at
+    startup and then every reconcile_frequency seconds.
     """
 
-    def __init__(self, frequency=_DEFAULT_CLEAN_FREQUENCY):
+    WATCH_MASK = (inotify.IN_CLOSE_WRITE | inotify.IN_CREATE |
+                  inotify.IN_MOVED_TO | inotify.IN_ATTRIB |
+                  inotify.IN_DELETE | inotify.IN_MOVED_FROM)
+
+    def __init__(self, frequency=_DEFAULT_CLEAN_FREQUENCY,
+                 reconcile_frequency=_DEFAULT_RECONCILE_FREQUENCY):
         threading.Thread.__init__(self, name='cleanup')
 
         self.frequency = frequency
+        self.reconcile_frequency = reconcile_frequency
+        self.sizes = {}
+        self.size = 0
         self.setDaemon(True)
 
     def run(self):
-        """Run the main garbage collector thread loop, cleaning files every
-        self.frequency seconds until the program is stopped."""
+        """Run the main garbage collector thread loop, cleaning files as
+        soon as the renderings directory goes above the high watermark, or
+        every self.frequency seconds without inotify, until the program is
+        stopped."""
 
         l.info("Cleanup thread started.")
 
+        try:
+            watcher = inotify.Watcher(RENDERING_RESULT_PATH, self.WATCH_MASK)
+        except OSError, e:
+            l.warning("Cannot watch %s (%s), checking its size every %ds." %
+                      (RENDERING_RESULT_PATH, e, self.frequency))
+            watcher = None
+
+        last_reconcile = 0
         while True:
-            self.cleanup()
-            time.sleep(self.frequency)
+            try:
+                if time.time() - last_reconcile >= self.reconcile_frequency:
+                    self.reconcile()
+                    last_reconcile = time.time()
 
-    def get_file_info(self, path):
-        """Returns a dictionary of information on the given file.
+                if watcher:
+                    self.watch(watcher,
+                               last_reconcile + self.reconcile_frequency)
+                else:
+                    self.cleanup(RenderingFile.objects.get_total_size())
+                    time.sleep(self.frequency)
+            except Exception:
+                l.exception("Error while cleaning the renderings!")
+                time.sleep(self.frequency)
 
-        Args:
-            path (string): the full path to the file.
-        Returns a dictionary containing:
-            * name: the file base name;
-            * path: its full path;
-            * size: its size;
-            * time: the last time the file contents were changed."""
-
-        s = os.stat(path)
-        return {'name': os.path.basename(path),
-                'path': path,
-                'size': s.st_size,
-                'time': s.st_mtime}
+    def watch(self, watcher, until):
+        """Follow the changes of the renderings directory until the given
+        time, and clean it up whenever the running total of its size goes
+        above the high watermark."""
+
+        self.cleanup(self.size)
+        while time.time() < until:
+            events = watcher.read(until - time.time())
+            for mask, name in events:
+                if mask & inotify.IN_Q_OVERFLOW:
+                    l.warning("Missed renderings directory changes, "
+                              "rescanning it.")
+                    self.rescan()
+                    break
+                self.update_size(mask, name)
+
+            if events:
+                self.cleanup(self.size)
+
+    def is_managed(self, name):
+        """Returns True if the given file of RENDERING_RESULT_PATH is taken
+        care of by the garbage collector."""
+        return not (name.startswith('.') or
+                    name.endswith(render.THUMBNAIL_SUFFIX))
+
+    def update_size(self, mask, name):
+        """Update the running total of the size of the renderings after the
+        given inotify event on the given file."""
+
+        if not name or mask & inotify.IN_ISDIR or not self.is_managed(name):
+            return
+
+        if mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+            self.size -= self.sizes.pop(name, 0)
+            return
+
+        try:
+            s = os.stat(os.path.join(RENDERING_RESULT_PATH, name))
+        except OSError:
+            # Already removed, the removal event is on its way.
+            return
+
+        # Files hard-linked between jobs only account for their share of the
+        # space they use. The share of the other links is only updated on
+        # their next event, or at the next reconciliation.
+        size = s.st_size / s.st_nlink
+        self.size += size - self.sizes.get(name, 0)
+        self.sizes[name] = size
+
+    def rescan(self):
+        """Recompute the running total of the size of the renderings from
+        the actual directory contents."""
+
+        self.sizes = {}
+        for path in self.list_files():
+            try:
+                s = os.stat(path)
+            except OSError:
+                continue
+            self.sizes[os.path.basename(path)] = s.st_size / s.st_nlink
+        self.size = sum(self.sizes.values())
+
+    def list_files(self):
+        """Returns the full paths of the files of RENDERING_RESULT_PATH the
+        garbage collector takes care of."""
+
+        return [os.path.join(RENDERING_RESULT_PATH, f)
+                for f in os.listdir(RENDERING_RESULT_PATH)
+                if self.is_managed(f)]
+
+    def reconcile(self):
+        """Bring the renderings index back in sync with the actual contents
+        of RENDERING_RESULT_PATH, catching files added or removed behind the
+        daemon's back and link counts changed by the removal of shared
+        files."""
+
+        start = time.time()
+        paths = self.list_files()
+        jobs = MapRenderingJob.objects.get_by_filenames(
+            [os.path.basename(path) for path in paths])
+        files = [(path, jobs.get(os.path.basename(path))) for path in paths]
+        added, updated, removed = RenderingFile.objects.reconcile(files)
+        self.sizes = dict(RenderingFile.objects.values_list('name', 'size'))
+        self.size = sum(self.sizes.values())
+        l.info("Reconciled the renderings index in %.1fs: %d files, %d "
+               "added, %d updated, %d removed, %s total." %
+               (time.time() - start, len(files), added, updated, removed,
+                self.get_formatted_value(
+                    RenderingFile.objects.get_total_size())))
 
     def get_formatted_value(self, value):
         """Returns the given value in bytes formatted for display, with its
@@ -179,65 +900,115 @@ class RenderingsGarbageCollector(threading.Thread):
                  self.get_formatted_value(size),
                  self.get_formatted_value(threshold))
 
-    def cleanup(self):
-        """Run one iteration of the cleanup loop. A sorted list of files from
-        the renderings directory is first created, oldest files last. Files are
-        then pop()-ed out of the list and removed by cleanup_files() until
-        we're back below the size threshold."""
-
-        files = map(lambda f: self.get_file_info(f),
-                    [os.path.join(RENDERING_RESULT_PATH, f)
-                        for f in os.listdir(RENDERING_RESULT_PATH)
-                        if not (f.startswith('.') or
-                                f.endswith(render.THUMBNAIL_SUFFIX))])
-
-        # Compute the total size occupied by the renderings, and the actual 80%
-        # threshold, in bytes.
-        size = reduce(lambda x,y: x+y['size'], files, 0)
-        threshold = 0.8 * RENDERING_RESULT_MAX_SIZE_GB * 1024 * 1024 * 1024
-
-        # Stop here if we are below the threshold
-        if size < threshold:
+    def cleanup(self, size):
+        """Run one iteration of the cleanup loop, given the total size of the
+        renderings. When above the high watermark, indexed files are
+        considered oldest first, and removed with the other files of their
+        job until we're back below the low watermark."""
+
+        # Compute the actual watermarks, in bytes.
+        max_size = RENDERING_RESULT_MAX_SIZE_GB * 1024 * 1024 * 1024
+        high = RENDERING_RESULT_HIGH_WATERMARK * max_size
+        threshold = RENDERING_RESULT_LOW_WATERMARK * max_size
+
+        # Stop here if we are below the high watermark
+        if size < high:
             return
 
-        l.info("%s consumed for a %s threshold. Cleaning..." %
+        l.info("%s consumed for a %s high watermark. Cleaning down to %s..." %
                (self.get_formatted_value(size),
+                self.get_formatted_value(high),
                 self.get_formatted_value(threshold)))
 
-        # Sort files by timestamp, oldest last, and start removing them by
-        # pop()-ing the list.
-        files.sort(lambda x,y: cmp(y['time'], x['time']))
-
-        while size > threshold:
-            if not len(files):
-                l.error("No files to remove and still above threshold! "
-                        "Something's wrong!")
-                return
-
-            f = files.pop()
-            l.debug("Considering file %s..." % f['name'])
-            job = MapRenderingJob.objects.get_by_filename(f['name'])
-            if job:
-                l.debug("Found matching parent job #%d." % job.id)
-                removed, saved = job.remove_all_files()
-                size -= saved
-                if removed:
-                    l.info("Removed %d files for job #%d (%s)." %
-                           (removed, job.id,
-                            self.get_formatted_details(saved, size,
-                                                       threshold)))
-
-            else:
-                # If we didn't find a parent job, it means this is an orphaned
-                # file, we can safely remove it to get back some disk space.
-                l.debug("No parent job found.")
-                os.remove(f['path'])
-                size -= f['size']
-                l.info("Removed orphan file %s (%s)." %
-                       (f['name'], self.get_formatted_details(f['size'],
-                                                              size,
-                                                              threshold)))
+        # Count the queries of the cleanup, even without DEBUG.
+        start = time.time()
+        debug = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        queries = len(connection.queries)
+        renderings = files = 0
 
+        try:
+            while size > threshold:
+                # The removed files leave the index, the next batch starts
+                # with the oldest remaining ones.
+                evicted = RenderingFile.objects.evict(size - threshold,
+                                                      _EVICTION_BATCH_SIZE)
+                if not evicted:
+                    l.error("No files to remove and still above threshold! "
+                            "Something's wrong!")
+                    break
+
+                for jobid, names, saved in evicted:
+                    size -= saved
+                    renderings += 1
+                    files += len(names)
+                    GC_RECLAIMED.inc(saved)
+                    if jobid:
+                        l.debug("Removed %d files for job #%d (%s)." %
+                                (len(names), jobid,
+                                 self.get_formatted_details(saved, size,
+                                                            threshold)))
+                    else:
+                        l.debug("Removed orphan file %s (%s)." %
+                                (', '.join(names),
+                                 self.get_formatted_details(saved, size,
+                                                            threshold)))
+        finally:
+            count = len(connection.queries) - queries
+            del connection.queries[queries:]
+            connection.use_debug_cursor = debug
+
+        elapsed = time.time() - start
+        l.info("Removed %d files of %d renderings in %.2fs, %.1f files/s, "
+               "%d queries (now %s/%s)." %
+               (files, renderings, elapsed, files / max(elapsed, 0.001), count,
+                self.get_formatted_value(size),
+                self.get_formatted_value(threshold)))
+
+class RenderingsDemoter(threading.Thread):
+    """
+    A thread moving the renderings older than RENDERING_COLD_AGE_DAYS to the
+    cold tier (see coldstorage), at most _DEMOTION_BATCH_SIZE of them every
+    frequency seconds. Recompressing renderings takes a while, so it is kept
+    out of the garbage collector thread, that must react to the changes of
+    the renderings directory right away.
+    """
+
+    def __init__(self, frequency=_DEMOTION_FREQUENCY):
+        threading.Thread.__init__(self, name='demotion')
+        self.frequency = frequency
+        self.setDaemon(True)
+
+    def run(self):
+        l.info("Cold tier demotion thread started.")
+
+        while True:
+            time.sleep(self.frequency)
+            try:
+                self.demote()
+            except Exception:
+                l.exception("Error while moving renderings to the cold tier!")
+                try:
+                    transaction.rollback_unless_managed()
+                except Exception:
+                    connection.close()
+
+    def demote(self):
+        """Move the oldest renderings older than RENDERING_COLD_AGE_DAYS to
+        the cold tier, at most _DEMOTION_BATCH_SIZE at a time."""
+
+        start = time.time()
+        before = start - RENDERING_COLD_AGE_DAYS * 86400
+        demoted = saved = 0
+        for job in RenderingFile.objects.get_demotable(before,
+                                                       _DEMOTION_BATCH_SIZE):
+            saved += coldstorage.demote(job)
+            demoted += 1
+
+        if demoted:
+            l.info("Moved %d renderings to the cold tier in %.1fs, saved "
+                   "%.1f MiB." % (demoted, time.time() - start,
+                                  saved / 1024.0 / 1024.0))
 
 if __name__ == '__main__':
     if (not os.path.exists(RENDERING_RESULT_PATH)
@@ -249,9 +1020,20 @@ if __name__ == '__main__':
 
     try:
         cleaner = RenderingsGarbageCollector()
-        daemon = ForkingMapOSMaticDaemon()
+        if DAEMON_WARM_WORKERS:
+            daemon = PreforkingMapOSMaticDaemon()
+        elif DAEMON_WORKERS > 1:
+            daemon = PoolingMapOSMaticDaemon()
+        else:
+            daemon = ForkingMapOSMaticDaemon()
+
+        if DAEMON_METRICS_PORT:
+            metrics.MetricsServer(DAEMON_METRICS_ADDRESS,
+                                  DAEMON_METRICS_PORT).start()
 
         cleaner.start()
+        if RENDERING_COLD_AGE_DAYS:
+            RenderingsDemoter().start()
         daemon.serve()
     except Exception, e:
         l.exception('Fatal error during daemon execution!')
@@ -0,0 +1,115 @@
+#!/usr/bin/python
+# coding: utf-8
+
+# maposmatic, the web front-end of the MapOSMatic city map generation system
+# Copyright (C) 2009  David Decotigny
+# Copyright (C) 2009  Frédéric Lehobey
+# Copyright (C) 2009  David Mentré
+# Copyright (C) 2009  Maxime Petazzoni
+# Copyright (C) 2009  Thomas Petazzoni
+# Copyright (C) 2009  Gaël Utard
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Minimal inotify binding, through ctypes, used by the renderings garbage
+# collector to follow the changes of the renderings directory instead of
+# polling it. Only available on Linux: elsewhere, Watcher() raises OSError.
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+
+IN_CLOEXEC     = 02000000
+
+_EVENT_HEADER = struct.Struct('iIII')
+_READ_SIZE = 64 * 1024
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _inotify_init1 = _libc.inotify_init1
+    _inotify_add_watch = _libc.inotify_add_watch
+    _inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                   ctypes.c_uint32]
+except (OSError, AttributeError):
+    _libc = None
+
+def _check(result):
+    if result < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return result
+
+class Watcher:
+    """
+    Watches the given directory for the events of the given mask. Not
+    thread-safe, only one thread should read() from a given watcher.
+    """
+
+    def __init__(self, path, mask):
+        if _libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+
+        self.path = path
+        self.__fd = _check(_inotify_init1(IN_CLOEXEC))
+        try:
+            _check(_inotify_add_watch(self.__fd, path, mask))
+        except OSError:
+            os.close(self.__fd)
+            raise
+
+    def fileno(self):
+        return self.__fd
+
+    def read(self, timeout=None):
+        """Wait for at most timeout seconds for events, and return the list
+        of (mask, name) events received, empty if none."""
+
+        try:
+            ready, _, _ = select.select([self], [], [], timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        if not ready:
+            return []
+
+        data = os.read(self.__fd, _READ_SIZE)
+        events = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset+length].rstrip('\0')
+            offset += length
+            events.append((mask, name))
+        return events
+
+    def close(self):
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+# coding: utf-8
+
+# maposmatic, the web front-end of the MapOSMatic city map generation system
+# Copyright (C) 2009  David Decotigny
+# Copyright (C) 2009  Frédéric Lehobey
+# Copyright (C) 2009  David Mentré
+# Copyright (C) 2009  Maxime Petazzoni
+# Copyright (C) 2009  Thomas Petazzoni
+# Copyright (C) 2009  Gaël Utard
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Rendering resource usage summary. The resources used by the jobs rendered
+# over the last days (CPU time, peak memory, I/O, output size) are aggregated
+# by layout, stylesheet and paper size, to size the rendering worker pools and
+# their memory limits. The peak memory is only averaged over the jobs whose
+# peak is known (see MapRenderingJobUsage).
+
+import sys
+from datetime import datetime, timedelta
+
+from django.db.models import Avg, Count, Max
+from www.maposmatic.models import MapRenderingJobUsage
+
+DEFAULT_DAYS = 30
+
+def summarize(days):
+    since = datetime.now() - timedelta(days)
+    return (MapRenderingJobUsage.objects
+            .filter(job__endofrendering_time__gte=since)
+            .values('job__layout', 'job__stylesheet',
+                    'job__paper_width_mm', 'job__paper_height_mm')
+            .annotate(count=Count('id'),
+                      cpu_user=Avg('cpu_user'), cpu_system=Avg('cpu_system'),
+                      max_cpu_user=Max('cpu_user'),
+                      rss=Avg('max_rss_kb'), max_rss=Max('max_rss_kb'),
+                      blocks_in=Avg('blocks_in'), blocks_out=Avg('blocks_out'),
+                      output_size=Avg('output_size'))
+            .order_by('job__layout', 'job__stylesheet',
+                      'job__paper_width_mm', 'job__paper_height_mm'))
+
+if __name__ == '__main__':
+    try:
+        days = len(sys.argv) > 1 and int(sys.argv[1]) or DEFAULT_DAYS
+    except ValueError:
+        sys.stderr.write('usage: %s [days]\n' % sys.argv[0])
+        sys.exit(3)
+
+    print 'Resources used by the jobs rendered in the last %d days ' \
+          '(averages, and maximums in parentheses):' % days
+    print '%-26s %-20s %-11s %5s %17s %8s %19s %9s %9s %9s' % \
+        ('layout', 'stylesheet', 'paper (mm)', 'jobs', 'user CPU (s)',
+         'sys (s)', 'peak RSS (MiB)', 'blk in', 'blk out', 'out (MiB)')
+
+    for s in summarize(days):
+        print '%-26s %-20s %-11s %5d %7.1f (%7.1f) %8.1f %8.0f (%8.0f) ' \
+              '%9d %9d %9.1f' % \
+            (s['job__layout'][:26], s['job__stylesheet'][:20],
+             '%dx%d' % (s['job__paper_width_mm'], s['job__paper_height_mm']),
+             s['count'], s['cpu_user'], s['max_cpu_user'], s['cpu_system'],
+             (s['rss'] or 0) / 1024, (s['max_rss'] or 0) / 1024.0,
+             s['blocks_in'],
+             s['blocks_out'], s['output_size'] / 1024 / 1024)
@@ -0,0 +1,198 @@
+#!/usr/bin/python
+# coding: utf-8
+
+# maposmatic, the web front-end of the MapOSMatic city map generation system
+# Copyright (C) 2009  David Decotigny
+# Copyright (C) 2009  Frédéric Lehobey
+# Copyright (C) 2009  David Mentré
+# Copyright (C) 2009  Maxime Petazzoni
+# Copyright (C) 2009  Thomas Petazzoni
+# Copyright (C) 2009  Gaël Utard
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Rendering daemon metrics, exposed over HTTP in the Prometheus text format.
+
+import BaseHTTPServer
+import logging
+import threading
+
+l = logging.getLogger('maposmatic')
+
+_metrics = []
+
+def _escape(value):
+    return (unicode(value).replace('\\', '\\\\').replace('\n', '\\n')
+            .replace('"', '\\"').encode('utf-8'))
+
+def _format_labels(names, values, extra=()):
+    labels = zip(names, values) + list(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (n, _escape(v)) for n, v in labels])
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class Metric:
+    """
+    Base class of the metrics. A metric holds one value per combination of
+    label values, given as keyword arguments when updating it.
+    """
+
+    TYPE = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple([labels.get(name, '') for name in self.labels])
+
+    def samples(self):
+        """Returns the list of (name, labels, value) samples of this
+        metric."""
+        self._lock.acquire()
+        try:
+            return [(self.name, _format_labels(self.labels, key), value)
+                    for key, value in sorted(self._values.items())]
+        finally:
+            self._lock.release()
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.description),
+                 '# TYPE %s %s' % (self.name, self.TYPE)]
+        for name, labels, value in self.samples():
+            lines.append('%s%s %s' % (name, labels, _format_value(value)))
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        self._lock.acquire()
+        try:
+            key = self._key(labels)
+            self._values[key] = self._values.get(key, 0) + amount
+        finally:
+            self._lock.release()
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def __init__(self, name, description, labels=(), function=None):
+        Metric.__init__(self, name, description, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        self._lock.acquire()
+        try:
+            self._values[self._key(labels)] = value
+        finally:
+            self._lock.release()
+
+    def samples(self):
+        # Gauges computed on demand, such as the queue size, are only
+        # computed when scraped.
+        if self.function:
+            try:
+                return [(self.name, '', self.function())]
+            except Exception:
+                l.exception("Could not compute the %s metric!" % self.name)
+                return []
+        return Metric.samples(self)
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    DEFAULT_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 3600)
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, description, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        self._lock.acquire()
+        try:
+            key = self._key(labels)
+            if key not in self._values:
+                self._values[key] = ([0] * len(self.buckets), 0.0)
+            counts, total = self._values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+        finally:
+            self._lock.release()
+
+    def samples(self):
+        self._lock.acquire()
+        try:
+            samples = []
+            for key, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    samples.append(('%s_bucket' % self.name,
+                                    _format_labels(self.labels, key,
+                                        [('le', _format_value(bound))]),
+                                    count))
+                labels = _format_labels(self.labels, key)
+                samples.append(('%s_sum' % self.name, labels, total))
+                samples.append(('%s_count' % self.name, labels, counts[-1]))
+            return samples
+        finally:
+            self._lock.release()
+
+def render():
+    """Returns all the metrics, in the Prometheus text exposition format."""
+    return '\n'.join([metric.render() for metric in _metrics]) + '\n'
+
+class _MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        l.debug("Metrics request from %s: %s" %
+                (self.client_address[0], format % args))
+
+class MetricsServer(threading.Thread):
+    """
+    A thread serving the metrics over HTTP, on /metrics.
+    """
+
+    def __init__(self, address, port):
+        threading.Thread.__init__(self, name='metrics')
+        self.setDaemon(True)
+        self.server = BaseHTTPServer.HTTPServer((address, port),
+                                                _MetricsRequestHandler)
+
+    def run(self):
+        l.info("Serving metrics on http://%s:%d/metrics." %
+               self.server.server_address)
+        self.server.serve_forever()
@@ -24,18 +24,32 @@
 
 import ctypes
 import datetime
+import errno
+import glob
 import Image
 import logging
 import multiprocessing
 import os
+import resource
+import signal
 import smtplib
 import sys
 import threading
+import time
 import traceback
 import subprocess
 
 import ocitysmap
 from ocitysmap import renderers
+
+# Poppler is used to rasterize PDF files for thumbnails when available;
+# ImageMagick is used otherwise.
+try:
+    import cairo
+    import poppler
+except ImportError:
+    poppler = None
+
 from www.maposmatic.models import MapRenderingJob
 from www.settings import ADMINS, OCITYSMAP_CFG_PATH
 from www.settings import RENDERING_RESULT_PATH, RENDERING_RESULT_FORMATS
@@ -43,14 +57,32 @@ from www.settings import DAEMON_ERRORS_SMTP_HOST, DAEMON_ERRORS_SMTP_PORT
 from www.settings import DAEMON_ERRORS_EMAIL_FROM
 from www.settings import DAEMON_ERRORS_EMAIL_REPLY_TO
 from www.settings import DAEMON_ERRORS_JOB_URL
+from www.settings import DAEMON_WORKER_MAX_JOBS, DAEMON_WORKER_MAX_RSS_MB
+from www.settings import DAEMON_PARALLEL_FORMATS
+from www.settings import DAEMON_MEMORY_LIMIT_MB, DAEMON_CGROUP_PATH
+from www.settings import DAEMON_LARGE_JOB_MEMORY_LIMIT_MB
 
 RESULT_SUCCESS = 0
 RESULT_KEYBOARD_INTERRUPT = 1
 RESULT_PREPARATION_EXCEPTION = 2
 RESULT_RENDERING_EXCEPTION = 3
 RESULT_TIMEOUT_REACHED = 4
+RESULT_CANCELLED = 5
+RESULT_MEMORY_EXCEEDED = 6
 
 THUMBNAIL_SUFFIX = '_small.png'
+THUMBNAIL_SIZE = (200, 200)
+
+# Resolution at which ImageMagick rasterizes PDF pages for thumbnails, in
+# DPI: about thumbnail size for usual paper sizes.
+THUMBNAIL_DENSITY = 30
+
+# prctl() option to get a signal when the parent process dies (Linux).
+PR_SET_PDEATHSIG = 1
+
+# Directory of RENDERING_RESULT_PATH where the jobs are rendered, before their
+# files are published.
+TEMPORARY_DIRNAME = '.rendering'
 
 EXCEPTION_EMAIL_TEMPLATE = """From: MapOSMatic rendering daemon <%(from)s>
 Reply-To: %(replyto)s
@@ -75,6 +107,78 @@ MapOSMatic
 
 l = logging.getLogger('maposmatic')
 
+def get_temporary_prefix(job):
+    """Returns the prefix of the files of the given job while it's being
+    rendered."""
+    return os.path.join(RENDERING_RESULT_PATH, TEMPORARY_DIRNAME,
+                        job.files_prefix())
+
+def remove_temporary_files(job):
+    """Remove the files left over by an aborted rendering of the given
+    job."""
+    for path in glob.glob(get_temporary_prefix(job) + '*'):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def remove_cancelled_files(job):
+    """Remove the files of the given cancelled job, including those it may
+    have published already, leaving its database entry alone."""
+    remove_temporary_files(job)
+    prefix = os.path.join(RENDERING_RESULT_PATH, job.files_prefix())
+    for path in glob.glob(prefix + '*'):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+class ProgressRecorder:
+    """
+    Records the rendering progress reported by a JobRenderer in the job's
+    database entry, and checks whether the job was cancelled. Progress
+    updates are coalesced: the latest one is written by flush(), at most once
+    every interval seconds.
+    """
+
+    def __init__(self, job, interval=1.0):
+        self.job = job
+        self.interval = interval
+        self.__pending = None
+        self.__last = 0
+        self.__checked = time.time()
+
+    def update(self, stage, done=None, total=None, percent=None):
+        self.__pending = (stage, done, total, percent)
+
+    def flush(self):
+        pending = self.__pending
+        if pending is None or time.time() - self.__last < self.interval:
+            return
+
+        self.__pending = None
+        self.__last = time.time()
+        try:
+            self.job.set_progress(*pending)
+        except Exception:
+            l.exception("Could not record the progress of job #%d!" %
+                        self.job.id)
+
+    def cancelled(self):
+        """Returns True if the job was cancelled. The job's database entry is
+        checked at most every interval seconds."""
+
+        if time.time() - self.__checked < self.interval:
+            return False
+
+        self.__checked = time.time()
+        try:
+            return self.job.was_cancelled()
+        except Exception:
+            l.exception("Could not check whether job #%d was cancelled!" %
+                        self.job.id)
+            return False
+
 class ThreadingJobRenderer:
     """
     The ThreadingJobRenderer is a wrapper around a JobRendered thread that
@@ -93,7 +197,13 @@ class ThreadingJobRenderer:
 
         self.__job = job
         self.__timeout = timeout
-        self.__thread = JobRenderer(job, prefix)
+        self.__progress = ProgressRecorder(job)
+        self.__thread = JobRenderer(job, prefix,
+                                    progress=self.__progress.update)
+        self.timings = []
+        # The resources used by a rendering thread can't be told apart from
+        # those of the rest of the process.
+        self.usage = None
 
     def run(self):
         """Renders the job using a JobRendered, encapsulating all processing
@@ -103,11 +213,18 @@ class ThreadingJobRenderer:
         """
 
         self.__thread.start()
-        self.__thread.join(self.__timeout)
+        deadline = time.time() + self.__timeout
+        while self.__thread.isAlive() and time.time() < deadline:
+            self.__thread.join(min(self.__progress.interval,
+                                   deadline - time.time()))
+            self.__progress.flush()
+            if self.__progress.cancelled():
+                return self.__cancel()
 
         # If the thread is no longer alive, the timeout was not reached and all
         # is well.
         if not self.__thread.isAlive():
+            self.timings = self.__thread.timings
             if self.__thread.result != 0:
                 self.__job.remove_all_files()
             return self.__thread.result
@@ -121,28 +238,81 @@ class ThreadingJobRenderer:
 
         # Remove the job files
         self.__job.remove_all_files()
+        remove_temporary_files(self.__job)
 
         l.debug("Worker removed.")
         return RESULT_TIMEOUT_REACHED
 
+    def __cancel(self):
+        l.info("Rendering of job #%d cancelled!" % self.__job.id)
+        try:
+            self.__thread.kill()
+        except (threading.ThreadError, ValueError, SystemError):
+            pass
+        remove_cancelled_files(self.__job)
+        return RESULT_CANCELLED
+
 
 class ForkingJobRenderer:
 
     def __init__(self, job, timeout=1200, prefix=None):
         self.__job = job
         self.__timeout = timeout
-        self.__renderer = JobRenderer(job, prefix)
+        self.__progress = ProgressRecorder(job)
+        self.__conn, self.__child_conn = multiprocessing.Pipe(False)
+        self.__renderer = JobRenderer(job, prefix, progress=self._report)
         self.__process = multiprocessing.Process(target=self._wrap)
+        self.timings = []
+        self.usage = None
+
+        self.__limit = None
+        limit_mb = get_memory_limit(job)
+        if limit_mb:
+            self.__limit = MemoryLimit('maposmatic-job-%d' % job.id, limit_mb)
+
+    def __receive(self, timeout):
+        """Handle the progress and timings messages of the rendering process,
+        waiting for at most timeout seconds for the first one."""
+        while self.__conn.poll(timeout):
+            kind, value = self.__conn.recv()
+            if kind == 'progress':
+                self.__progress.update(*value)
+            elif kind == 'usage':
+                self.usage = value
+            else:
+                self.timings = value
+            timeout = 0
 
     def run(self):
+        try:
+            return self.__run()
+        finally:
+            if self.__limit:
+                self.__limit.release()
+
+    def __run(self):
         self.__process.start()
-        self.__process.join(self.__timeout)
+        deadline = time.time() + self.__timeout
+        while self.__process.is_alive() and time.time() < deadline:
+            self.__receive(max(0, min(self.__progress.interval,
+                                      deadline - time.time())))
+            self.__progress.flush()
+            if self.__progress.cancelled():
+                return self.__cancel()
+        self.__receive(0)
 
         # If the process is no longer alive, the timeout was not reached and
         # all is well.
         if not self.__process.is_alive():
+            self.__process.join()
             if self.__process.exitcode != 0:
                 self.__job.remove_all_files()
+                remove_temporary_files(self.__job)
+
+            if self.__limit and self.__limit.exceeded():
+                l.info("Rendering of job #%d went over the %d MiB memory "
+                       "limit!" % (self.__job.id, self.__limit.limit_mb))
+                return RESULT_MEMORY_EXCEEDED
 
             # If the exit code is < 0, it means the subprocess was terminated
             # abnormaly (by signal). In this situation, we need to report a
@@ -160,12 +330,407 @@ class ForkingJobRenderer:
 
         # Remove job files
         self.__job.remove_all_files()
+        remove_temporary_files(self.__job)
 
         l.debug("Process terminated.")
         return RESULT_TIMEOUT_REACHED
 
+    def __cancel(self):
+        l.info("Rendering of job #%d cancelled!" % self.__job.id)
+        self.__process.terminate()
+        self.__process.join()
+        remove_cancelled_files(self.__job)
+        return RESULT_CANCELLED
+
+    def _report(self, *progress):
+        self.__child_conn.send(('progress', progress))
+
     def _wrap(self):
-        sys.exit(self.__renderer.run())
+        if self.__limit:
+            self.__limit.apply()
+        result = self.__renderer.run()
+        self.__child_conn.send(('timings', self.__renderer.timings))
+        # The whole life of this process is spent on the job.
+        self.__child_conn.send(('usage', get_usage()))
+        sys.exit(result)
+
+
+def die_with_parent():
+    """Have the current process killed when its parent dies. Only supported
+    on Linux, does nothing elsewhere."""
+    try:
+        ctypes.CDLL(None).prctl(PR_SET_PDEATHSIG, signal.SIGKILL)
+    except (OSError, AttributeError):
+        pass
+
+def rasterize_pdf_pages(path, pages, size):
+    """Rasterize the given pages of a PDF file with Poppler, each directly at
+    the resolution making it fit in the given (width, height) size in pixels.
+
+    Returns the list of the page images."""
+
+    document = poppler.document_new_from_file(
+        'file://' + os.path.abspath(path), None)
+
+    images = []
+    for n in pages:
+        if n >= document.get_n_pages():
+            continue
+
+        page = document.get_page(n)
+        width, height = page.get_size()
+        scale = min(size[0] / width, size[1] / height)
+        image_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+
+        surface = cairo.ImageSurface(cairo.FORMAT_RGB24, *image_size)
+        ctx = cairo.Context(surface)
+        ctx.set_source_rgb(1, 1, 1)
+        ctx.paint()
+        ctx.scale(scale, scale)
+        page.render(ctx)
+        surface.flush()
+
+        images.append(Image.frombuffer('RGB', image_size, surface.get_data(),
+                                       'raw', 'BGRX', surface.get_stride(),
+                                       1))
+    return images
+
+def tile_images(images, horizontal, spacing=10):
+    """Returns an image with the given images side by side, or one above the
+    other."""
+
+    if horizontal:
+        size = (sum([i.size[0] for i in images]) + spacing * (len(images) - 1),
+                max([i.size[1] for i in images]))
+    else:
+        size = (max([i.size[0] for i in images]),
+                sum([i.size[1] for i in images]) + spacing * (len(images) - 1))
+
+    tiled = Image.new('RGB', size, 'white')
+    offset = 0
+    for image in images:
+        if horizontal:
+            tiled.paste(image, (offset, 0))
+            offset += image.size[0] + spacing
+        else:
+            tiled.paste(image, (0, offset))
+            offset += image.size[1] + spacing
+    return tiled
+
+def get_memory_limit(job):
+    """Returns the memory limit of the rendering of the given job, in MiB, or
+    None if it's not limited."""
+    if job.large and DAEMON_LARGE_JOB_MEMORY_LIMIT_MB:
+        return DAEMON_LARGE_JOB_MEMORY_LIMIT_MB
+    return DAEMON_MEMORY_LIMIT_MB
+
+def set_memory_limit(limit_mb):
+    """Limit the address space of the current process, and of the processes
+    it starts, to limit_mb MiB, or lift the limit if None. Only the soft limit
+    is set, so that it can be lifted."""
+    limit = limit_mb and limit_mb * 1024 * 1024 or resource.RLIM_INFINITY
+    hard = resource.getrlimit(resource.RLIMIT_AS)[1]
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+def is_memory_error(e):
+    """Returns True if the given exception comes from a failed memory
+    allocation, in Python or in the C++ rendering libraries."""
+    return isinstance(e, MemoryError) or 'bad_alloc' in str(e)
+
+class MemoryLimit:
+    """
+    Limits the memory used by a rendering process, and the processes it
+    starts, to limit_mb MiB. A cgroup is created under DAEMON_CGROUP_PATH
+    when set, so that the processes are killed by the kernel when they go over
+    the limit. Otherwise, the address space of each process is limited, and
+    memory allocations fail past the limit.
+    """
+
+    def __init__(self, name, limit_mb):
+        self.limit_mb = limit_mb
+        self.cgroup = None
+        self.__oom_kills = 0
+
+        if not DAEMON_CGROUP_PATH:
+            return
+
+        path = os.path.join(DAEMON_CGROUP_PATH, name)
+        try:
+            if not os.path.isdir(path):
+                os.mkdir(path)
+        except OSError, e:
+            l.warning("Could not create cgroup %s (%s), using resource "
+                      "limits instead." % (path, e))
+            return
+
+        try:
+            self.__write(path, 'memory.max', limit_mb * 1024 * 1024)
+            # Don't let the processes slow down the host by swapping, when
+            # swap accounting is enabled.
+            try:
+                self.__write(path, 'memory.swap.max', 0)
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            self.cgroup = path
+            self.__oom_kills = self.__read_oom_kills()
+        except (IOError, OSError, ValueError), e:
+            l.warning("Could not set up cgroup %s (%s), using resource "
+                      "limits instead." % (path, e))
+            self.cgroup = None
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+
+    def __write(self, path, name, value):
+        with open(os.path.join(path, name), 'w') as f:
+            f.write(str(value))
+
+    def __read_oom_kills(self):
+        with open(os.path.join(self.cgroup, 'memory.events')) as f:
+            for line in f:
+                key, value = line.split()
+                if key == 'oom_kill':
+                    return int(value)
+        return 0
+
+    def apply(self):
+        """Apply the limit to the current process. Called by the rendering
+        process itself."""
+        if self.cgroup:
+            try:
+                self.__write(self.cgroup, 'cgroup.procs', os.getpid())
+                return
+            except (IOError, OSError), e:
+                l.warning("Could not join cgroup %s (%s), using resource "
+                          "limits instead." % (self.cgroup, e))
+        set_memory_limit(self.limit_mb)
+
+    def exceeded(self):
+        """Returns True if processes were killed for going over the limit,
+        which is only known with cgroups."""
+        if not self.cgroup:
+            return False
+        try:
+            return self.__read_oom_kills() > self.__oom_kills
+        except (IOError, OSError, ValueError):
+            return False
+
+    def release(self):
+        """Remove the cgroup, once all its processes are gone."""
+        if not self.cgroup:
+            return
+
+        for i in range(10):
+            try:
+                os.rmdir(self.cgroup)
+                return
+            except OSError:
+                time.sleep(0.1)
+        l.warning("Could not remove cgroup %s!" % self.cgroup)
+
+def get_rss():
+    """Returns the resident set size of the current process, in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def get_usage(since=None):
+    """Returns the resources used by the current process and its terminated
+    children (CPU time, peak resident memory, I/O), as a dictionary of
+    MapRenderingJobUsage fields. When given the usage returned by an earlier
+    call, only the resources used since then are counted. The peak memory
+    can't be reset: it's only known if it went up since then, and None
+    otherwise, since it's the peak of an earlier job then."""
+
+    usage = {'cpu_user': 0.0, 'cpu_system': 0.0, 'max_rss_kb': 0,
+             'blocks_in': 0, 'blocks_out': 0}
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        r = resource.getrusage(who)
+        usage['cpu_user'] += r.ru_utime
+        usage['cpu_system'] += r.ru_stime
+        usage['max_rss_kb'] = max(usage['max_rss_kb'], r.ru_maxrss)
+        usage['blocks_in'] += r.ru_inblock
+        usage['blocks_out'] += r.ru_oublock
+
+    if since:
+        for k in ('cpu_user', 'cpu_system', 'blocks_in', 'blocks_out'):
+            usage[k] -= since[k]
+        if usage['max_rss_kb'] <= since['max_rss_kb']:
+            usage['max_rss_kb'] = None
+    return usage
+
+class RenderingWorker:
+    """
+    A long-lived rendering process. The worker process is forked once, and
+    keeps its OCitySMap instance, with its configuration and GIS database
+    connection, across the jobs it renders. Jobs are sent to the worker
+    process, and results sent back, through a pipe.
+
+    Only these stay warm: OCitySMap loads and parses the Mapnik stylesheet
+    of a job within each rendering, and offers no way to reuse a loaded
+    stylesheet. The fonts are registered by Mapnik when it's imported, that
+    is once for all the rendering processes.
+
+    The worker process is recycled after max_jobs jobs, or when its resident
+    memory goes above max_rss_mb MiB.
+    """
+
+    def __init__(self, prefix, max_jobs=DAEMON_WORKER_MAX_JOBS,
+                 max_rss_mb=DAEMON_WORKER_MAX_RSS_MB):
+        self.prefix = prefix
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss_mb * 1024 * 1024
+        self.jobs = 0
+        self.timings = []
+        self.usage = None
+        self.__process = None
+        self.__conn = None
+
+    def is_alive(self):
+        return self.__process is not None and self.__process.is_alive()
+
+    def start(self):
+        """Fork the worker process."""
+        self.__conn, conn = multiprocessing.Pipe()
+        self.__process = multiprocessing.Process(target=self._serve,
+                                                 args=(conn,),
+                                                 name='worker-%s' % self.prefix)
+        self.__process.start()
+        conn.close()
+        self.jobs = 0
+
+    def stop(self, kill=False):
+        """Stop the worker process, either letting it finish its current job,
+        or killing it right away."""
+        if self.__process is None:
+            return
+
+        if kill:
+            self.__process.terminate()
+        else:
+            try:
+                self.__conn.send(None)
+            except IOError:
+                pass
+        self.__process.join()
+        self.__conn.close()
+        self.__process = None
+        self.__conn = None
+
+    def render(self, job, timeout, progress=None):
+        """Render the given job in the worker process, starting it if needed.
+        The rendering progress is recorded with the given ProgressRecorder.
+
+        Returns one of the RESULT_ constants."""
+
+        if not self.is_alive():
+            self.stop(kill=True)
+            self.start()
+
+        self.timings = []
+        self.usage = None
+        self.__conn.send(job)
+        deadline = time.time() + timeout
+        try:
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.stop(kill=True)
+                    return RESULT_TIMEOUT_REACHED
+
+                if self.__conn.poll(min(1, remaining)):
+                    kind, value = self.__conn.recv()
+                    if kind == 'result':
+                        result, rss, self.timings, self.usage = value
+                        break
+                    if progress:
+                        progress.update(*value)
+                if progress:
+                    progress.flush()
+                    if progress.cancelled():
+                        self.stop(kill=True)
+                        return RESULT_CANCELLED
+        except EOFError:
+            # The worker process died while rendering.
+            self.stop(kill=True)
+            return RESULT_RENDERING_EXCEPTION
+
+        self.jobs += 1
+        if result == RESULT_MEMORY_EXCEEDED:
+            # Don't keep a process that ran out of memory.
+            l.info("Restarting rendering worker %s after it went over its "
+                   "memory limit." % self.prefix)
+            self.stop()
+        elif self.jobs >= self.max_jobs or rss > self.max_rss:
+            l.info("Recycling rendering worker %s after %d jobs (%d MiB)." %
+                   (self.prefix, self.jobs, rss / 1024 / 1024))
+            self.stop()
+        return result
+
+    def _serve(self, conn):
+        """Main loop of the worker process."""
+
+        start = time.time()
+        try:
+            renderer = ocitysmap.OCitySMap(OCITYSMAP_CFG_PATH)
+        except Exception:
+            l.exception("Could not start rendering worker %s!" % self.prefix)
+            renderer = None
+        l.info("Rendering worker %s ready in %.2fs." %
+               (self.prefix, time.time() - start))
+
+        while True:
+            try:
+                job = conn.recv()
+            except (EOFError, KeyboardInterrupt):
+                break
+            if job is None:
+                break
+
+            report = lambda *progress: conn.send(('progress', progress))
+            job_renderer = JobRenderer(job, self.prefix, renderer, report)
+            usage = get_usage()
+            # The memory of long-lived workers is limited with resource
+            # limits only, set for each job.
+            set_memory_limit(get_memory_limit(job))
+            result = job_renderer.run()
+            set_memory_limit(None)
+            conn.send(('result', (result, get_rss(), job_renderer.timings,
+                                  get_usage(usage))))
+
+class WarmJobRenderer:
+    """
+    Renders a job in a long-lived RenderingWorker, with the same timeout and
+    clean up behavior as the ForkingJobRenderer.
+    """
+
+    def __init__(self, job, worker, timeout=1200, prefix=None):
+        self.__job = job
+        self.__worker = worker
+        self.__timeout = timeout
+        self.timings = []
+        self.usage = None
+
+    def run(self):
+        result = self.__worker.render(self.__job, self.__timeout,
+                                      ProgressRecorder(self.__job))
+        self.timings = self.__worker.timings
+        self.usage = self.__worker.usage
+
+        if result == RESULT_TIMEOUT_REACHED:
+            l.info("Rendering of job #%d took too long (timeout reached)!" %
+                   self.__job.id)
+        if result == RESULT_CANCELLED:
+            l.info("Rendering of job #%d cancelled!" % self.__job.id)
+            remove_cancelled_files(self.__job)
+        elif result != RESULT_SUCCESS:
+            self.__job.remove_all_files()
+            remove_temporary_files(self.__job)
+        return result
 
 
 class JobRenderer(threading.Thread):
@@ -173,11 +738,30 @@ class JobRenderer(threading.Thread):
     A simple, blocking job renderer. Can be used as a thread.
     """
 
-    def __init__(self, job, prefix):
+    # Overall progress of the rendering at the start of each stage, in
+    # percent. The rendering of the output formats goes from 10 to 90%.
+    STAGES_PROGRESS = {'setup': 0, 'preparation': 5, 'render': 10,
+                       'thumbnail': 90, 'publication': 95}
+
+    def __init__(self, job, prefix, renderer=None, progress=None):
+        """Initializes this JobRenderer with a given job.
+
+        Args:
+            job (MapRenderingJob): the job to render.
+            prefix (string): renderer map_areas table prefix.
+            renderer (OCitySMap): an already set up OCitySMap instance to
+                render the job with, instead of creating a new one.
+            progress (callable): called with the stage name, the number of
+                steps of the stage done and its total number of steps, and the
+                overall progress in percent, as the rendering progresses.
+        """
         threading.Thread.__init__(self, name='renderer-%d' % job.id)
         self.job = job
         self.prefix = prefix
+        self.renderer = renderer
+        self.progress = progress
         self.result = None
+        self.timings = []
 
     def __get_my_tid(self):
         if not self.isAlive():
@@ -246,37 +830,196 @@ class JobRenderer(threading.Thread):
             l.exception("Could not send error email to the admins!")
 
     def _gen_thumbnail(self, prefix, paper_width_mm, paper_height_mm):
+        """Create the thumbnail of the map, from its PNG rendering when
+        available, or from the first pages of its PDF rendering otherwise."""
+
         l.info('Creating map thumbnail...')
+        thumbnail = prefix + THUMBNAIL_SUFFIX
+
+        if self.job.layout != "multi_page" and os.path.exists(prefix + '.png'):
+            img = Image.open(prefix + '.png')
+            # Cheaply shrink the image by an integer factor first, keeping
+            # twice the thumbnail size, so that the antialiased scaling only
+            # works on a small image. PNG images can't be decoded at a reduced
+            # resolution.
+            factor = min(img.size[0] / THUMBNAIL_SIZE[0],
+                         img.size[1] / THUMBNAIL_SIZE[1]) / 2
+            if factor > 1:
+                img = img.resize((img.size[0] / factor, img.size[1] / factor),
+                                 Image.NEAREST)
+            img.thumbnail(THUMBNAIL_SIZE, Image.ANTIALIAS)
+            img.save(thumbnail)
+            return
+
+        if not os.path.exists(prefix + '.pdf'):
+            return
 
+        # The thumbnail of multi-page maps shows the cover page and the
+        # overview page: side by side when rendering portrait, one above the
+        # other when rendering landscape.
         if self.job.layout == "multi_page":
-            # Depending on whether we're rendering landscape or
-            # portrait, adapt how the tiling is done.
-            if paper_width_mm > paper_height_mm:
-                tile = "1x2"
-            else:
-                tile = "2x1"
-
-            # With the 'montage' command from ImageMagick, create an
-            # image with the first two pages of the PDF (cover page
-            # and overview page).
-            montage_cmd = [ "montage", "-tile", tile, "%s.pdf[0]" % prefix,
-                            "%s.pdf[2]" % prefix, "-geometry", "+10+10",
-                            "-shadow", "%s%s" % (prefix, THUMBNAIL_SUFFIX) ]
-            subprocess.check_call(montage_cmd)
-
-            # And now scale it to the normal thumbnail size
-            mogrify_cmd = [ "mogrify", "-scale", "200x200",
-                            "%s%s" % (prefix, THUMBNAIL_SUFFIX) ]
-            subprocess.check_call(mogrify_cmd)
-
-        elif 'png' in RENDERING_RESULT_FORMATS:
-                img = Image.open(prefix + '.png')
-                img.thumbnail((200, 200), Image.ANTIALIAS)
-                img.save(prefix + THUMBNAIL_SUFFIX)
+            pages = [0, 2]
+        else:
+            pages = [0]
+        horizontal = paper_width_mm <= paper_height_mm
+
+        if poppler:
+            img = tile_images(rasterize_pdf_pages(prefix + '.pdf', pages,
+                                                  THUMBNAIL_SIZE),
+                              horizontal)
+            img.thumbnail(THUMBNAIL_SIZE, Image.ANTIALIAS)
+            img.save(thumbnail)
+            return
+
+        # With the 'montage' command from ImageMagick, create an image with
+        # the pages rasterized at low resolution, and scale it to the
+        # thumbnail size.
+        montage_cmd = ["montage", "-density", str(THUMBNAIL_DENSITY),
+                       "-tile", horizontal and "%dx1" % len(pages) or
+                                "1x%d" % len(pages)]
+        montage_cmd += ["%s.pdf[%d]" % (prefix, page) for page in pages]
+        montage_cmd += ["-geometry", "+10+10", "-shadow", thumbnail]
+        subprocess.check_call(montage_cmd)
+
+        mogrify_cmd = ["mogrify", "-scale", "%dx%d" % THUMBNAIL_SIZE,
+                       thumbnail]
+        subprocess.check_call(mogrify_cmd)
+
+    def _progress(self, stage, done=None, total=None):
+        """Report the progress of the rendering, if requested."""
+        if not self.progress:
+            return
+
+        percent = self.STAGES_PROGRESS[stage]
+        if stage == 'render' and total:
+            percent += (self.STAGES_PROGRESS['thumbnail'] - percent) * \
+                done / total
+        self.progress(stage, done, total, percent)
+
+    def _time(self, stage, start):
+        """Record the time spent in the given stage since start, and return
+        the current time."""
+        now = time.time()
+        self.timings.append((stage, now - start))
+        return now
+
+    def _time_formats(self, prefix, output_formats, start):
+        """Record the rendering time of each output format. The renderer
+        produces the formats one after the other, so their rendering times are
+        derived from the modification times of the output files."""
+
+        done = []
+        for output_format in output_formats:
+            path = '%s.%s' % (prefix, output_format)
+            if os.path.exists(path):
+                done.append((os.path.getmtime(path), output_format))
+
+        last = start
+        for mtime, output_format in sorted(done):
+            self.timings.append(('render.%s' % output_format,
+                                 max(0, mtime - last)))
+            last = mtime
+
+    def _render_formats(self, config, output_formats, part_prefix,
+                        tmp_prefix, conn):
+        """Render the given output formats of the job to part_prefix, in a
+        process started by _render_parallel(), move them to tmp_prefix, and
+        send their rendering time back through the given connection."""
+
+        # Don't linger if the job is killed on timeout.
+        die_with_parent()
+
+        start = time.time()
+        try:
+            # The renderer's GIS database connection can't be shared with the
+            # other processes.
+            renderer = ocitysmap.OCitySMap(OCITYSMAP_CFG_PATH)
+            renderer.render(config, self.job.layout, output_formats,
+                            part_prefix)
+            for output_format in output_formats:
+                os.rename('%s.%s' % (part_prefix, output_format),
+                          '%s.%s' % (tmp_prefix, output_format))
+        except Exception, e:
+            l.exception("Rendering of the %s format(s) of job #%d failed!" %
+                        (', '.join(output_formats), self.job.id))
+            sys.exit(is_memory_error(e) and RESULT_MEMORY_EXCEEDED or 1)
+        conn.send(time.time() - start)
+
+    def _render_parallel(self, config, output_formats, tmp_prefix):
+        """Render each map output format in its own process, all at the same
+        time, and wait for the last one to finish.
+
+        Only the geographic lookup done during the preparation is shared with
+        these processes, through the rendering configuration: OCitySMap
+        prepares the map areas and the street index within each rendering,
+        and can't share them between renderings. Each process thus repeats
+        this preparation, and the PostGIS load of the job is multiplied by
+        the number of processes. The CSV index, that only needs the
+        preparation, is rendered along with the first map format rather than
+        in a process of its own. Each process renders to its own prefix, so
+        that they don't overwrite each other's files."""
+
+        groups = [[f] for f in output_formats if f != 'csv']
+        if 'csv' in output_formats:
+            groups[0].append('csv')
+
+        processes = []
+        timed = len(self.timings)
+        try:
+            for formats in groups:
+                part_prefix = '%s-%s' % (tmp_prefix, formats[0])
+                conn, child_conn = multiprocessing.Pipe(False)
+                process = multiprocessing.Process(
+                    target=self._render_formats,
+                    args=(config, formats, part_prefix, tmp_prefix,
+                          child_conn),
+                    name='renderer-%d-%s' % (self.job.id, formats[0]))
+                process.start()
+                child_conn.close()
+                processes.append((formats, part_prefix, process, conn))
+
+            failed = []
+            out_of_memory = False
+            for formats, part_prefix, process, conn in processes:
+                process.join()
+                if process.exitcode == 0 and conn.poll():
+                    self.timings.append(('render.%s' % '+'.join(formats),
+                                         conn.recv()))
+                else:
+                    failed += formats
+                    if process.exitcode == RESULT_MEMORY_EXCEEDED:
+                        out_of_memory = True
+                self._progress('render', len(self.timings) - timed +
+                               len(failed), len(groups))
+        finally:
+            for formats, part_prefix, process, conn in processes:
+                if process.is_alive():
+                    process.terminate()
+                conn.close()
+                # Don't publish the other files of the partial renderings.
+                for path in glob.glob(part_prefix + '*'):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+        if out_of_memory:
+            raise MemoryError("Not enough memory to render the %s format(s)"
+                              % ', '.join(failed))
+        if failed:
+            raise RuntimeError("Could not render the %s format(s)" %
+                               ', '.join(failed))
+
+    def _publish(self, tmp_prefix, prefix):
+        """Move the rendered files in place, making them available all at
+        once."""
+        for path in glob.glob(tmp_prefix + '*'):
+            os.rename(path, prefix + path[len(tmp_prefix):])
 
     def run(self):
         """Renders the given job, encapsulating all processing errors and
-        exceptions.
+        exceptions. The time spent in each rendering stage is recorded in
+        self.timings, as a list of (stage, seconds) tuples.
 
         This does not affect the job entry in the database in any way. It's the
         responsibility of the caller to do maintain the job status in the
@@ -286,9 +1029,18 @@ class JobRenderer(threading.Thread):
         """
 
         l.info("Rendering job #%d '%s'..." % (self.job.id, self.job.maptitle))
+        self.timings = []
 
         try:
-            renderer = ocitysmap.OCitySMap(OCITYSMAP_CFG_PATH)
+            self._progress('setup')
+            start = time.time()
+            renderer = self.renderer or ocitysmap.OCitySMap(OCITYSMAP_CFG_PATH)
+            l.info("Renderer for job #%d set up in %.3fs (%s)." %
+                   (self.job.id, time.time() - start,
+                    self.renderer and 'warm' or 'cold'))
+            start = self._time('setup', start)
+            self._progress('preparation')
+
             config = ocitysmap.RenderingConfiguration()
             config.title = self.job.maptitle
             config.osmid = self.job.administrative_osmid
@@ -298,6 +1050,7 @@ class JobRenderer(threading.Thread):
                     = renderer.get_geographic_info(config.osmid)
                 config.bounding_box = ocitysmap.coords.BoundingBox.parse_wkt(
                     bbox_wkt)
+                start = self._time('bbox', start)
             else:
                 config.bounding_box = ocitysmap.coords.BoundingBox(
                         self.job.lat_upper_left,
@@ -310,18 +1063,28 @@ class JobRenderer(threading.Thread):
                 self.job.stylesheet)
             config.paper_width_mm = self.job.paper_width_mm
             config.paper_height_mm = self.job.paper_height_mm
+            start = self._time('preparation', start)
         except KeyboardInterrupt:
             self.result = RESULT_KEYBOARD_INTERRUPT
             l.info("Rendering of job #%d interrupted!" % self.job.id)
             return self.result
         except Exception, e:
+            if is_memory_error(e):
+                self.result = RESULT_MEMORY_EXCEEDED
+                l.exception("Rendering of job #%d ran out of memory during "
+                            "data preparation!" % self.job.id)
+                return self.result
+
             self.result = RESULT_PREPARATION_EXCEPTION
             l.exception("Rendering of job #%d failed (exception occurred during"
                         " data preparation)!" % self.job.id)
             self._email_exception(e)
             return self.result
 
+        # Render in a temporary location, and only publish the files once
+        # they're all rendered.
         prefix = os.path.join(RENDERING_RESULT_PATH, self.job.files_prefix())
+        tmp_prefix = get_temporary_prefix(self.job)
 
         try:
             # Get the list of output formats (PNG, PDF, SVGZ, CSV)
@@ -334,26 +1097,54 @@ class JobRenderer(threading.Thread):
             output_formats = \
                 list(set(compatible_output_formats) & set(RENDERING_RESULT_FORMATS))
 
-            renderer.render(config, self.job.layout,
-                            output_formats, prefix)
+            if not os.path.isdir(os.path.dirname(tmp_prefix)):
+                os.makedirs(os.path.dirname(tmp_prefix))
+
+            # The pages of multi_page maps are all drawn by a single
+            # OCitySMap.render() call, which can't render a range of pages:
+            # their rendering can't be split across processes.
+            self._progress('render', 0, len(output_formats))
+            map_formats = [f for f in output_formats if f != 'csv']
+            if DAEMON_PARALLEL_FORMATS and len(map_formats) > 1:
+                self._render_parallel(config, output_formats, tmp_prefix)
+            else:
+                renderer.render(config, self.job.layout,
+                                output_formats, tmp_prefix)
+                self._time_formats(tmp_prefix, output_formats, start)
+            start = time.time()
 
             # Create thumbnail
-            self._gen_thumbnail(prefix, config.paper_width_mm,
+            self._progress('thumbnail')
+            self._gen_thumbnail(tmp_prefix, config.paper_width_mm,
                                 config.paper_height_mm)
+            start = self._time('thumbnail', start)
+
+            self._progress('publication')
+            self._publish(tmp_prefix, prefix)
+            self._time('publication', start)
 
             self.result = RESULT_SUCCESS
-            l.info("Finished rendering of job #%d." % self.job.id)
+            l.info("Finished rendering of job #%d (%s)." %
+                   (self.job.id, ', '.join(['%s: %.1fs' % t
+                                            for t in self.timings])))
         except KeyboardInterrupt:
             self.result = RESULT_KEYBOARD_INTERRUPT
             l.info("Rendering of job #%d interrupted!" % self.job.id)
         except Exception, e:
-            self.result = RESULT_RENDERING_EXCEPTION
-            l.exception("Rendering of job #%d failed (exception occurred during"
-                        " rendering)!" % self.job.id)
-            self._email_exception(e)
+            if is_memory_error(e):
+                self.result = RESULT_MEMORY_EXCEEDED
+                l.exception("Rendering of job #%d ran out of memory!" %
+                            self.job.id)
+            else:
+                self.result = RESULT_RENDERING_EXCEPTION
+                l.exception("Rendering of job #%d failed (exception occurred "
+                            "during rendering)!" % self.job.id)
+                self._email_exception(e)
 
-        return self.result
+        if self.result != RESULT_SUCCESS:
+            remove_temporary_files(self.job)
 
+        return self.result
 
 if __name__ == '__main__':
     def usage():
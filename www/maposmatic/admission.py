@@ -0,0 +1,113 @@
+# coding: utf-8
+
+# maposmatic, the web front-end of the MapOSMatic city map generation system
+# Copyright (C) 2009  David Decotigny
+# Copyright (C) 2009  Frédéric Lehobey
+# Copyright (C) 2009  David Mentré
+# Copyright (C) 2009  Maxime Petazzoni
+# Copyright (C) 2009  Thomas Petazzoni
+# Copyright (C) 2009  Gaël Utard
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Admission control of the new jobs. Submissions are refused when their
+# submitter sent too many of them lately (a token bucket per IP address,
+# stored in the Django cache), or when the work already waiting in the queue,
+# in estimated rendering seconds, is over a limit. The submitter of a refused
+# job is sent to an identical job already in the queue when there's one, since
+# the rendering of this job will serve identical jobs too.
+
+import time
+
+from django.core.cache import cache
+from django.db.models import Count, Sum
+
+import www.settings
+from www.maposmatic.models import MapRenderingJob, RenderingDaemon
+
+CACHE_KEY = 'maposmatic-admission-%s'
+
+class Refusal:
+    """
+    The reason why a job was refused: 'rate' when its submitter sent too many
+    jobs, 'busy' when the queue is full; the number of seconds after which
+    submitting it again should succeed, and the identical job already queued
+    that the submitter can wait for instead, if any.
+    """
+
+    def __init__(self, reason, retry_after, existing=None):
+        self.reason = reason
+        self.retry_after = int(retry_after)
+        self.existing = existing
+
+def _take_token(ip):
+    """Take a token from the bucket of the given IP address, refilled at
+    ADMISSION_RATE_PER_HOUR tokens per hour up to ADMISSION_BURST tokens.
+
+    Returns 0 if a token was taken, or the number of seconds until the next
+    token otherwise."""
+
+    rate = www.settings.ADMISSION_RATE_PER_HOUR / 3600.0
+    burst = www.settings.ADMISSION_BURST
+    now = time.time()
+
+    key = CACHE_KEY % ip
+    tokens, last = cache.get(key, (burst, now))
+    tokens = min(burst, tokens + (now - last) * rate)
+    if tokens < 1:
+        cache.set(key, (tokens, now), int(burst / rate))
+        return (1 - tokens) / rate
+
+    cache.set(key, (tokens - 1, now), int(burst / rate))
+    return 0
+
+def get_pending_seconds():
+    """Returns the estimated rendering time of all the waiting jobs, in
+    seconds."""
+
+    pending = (MapRenderingJob.objects.filter(status=0)
+               .aggregate(cost=Sum('estimated_cost'),
+                          count=Count('id'), estimated=Count('estimated_cost')))
+    return ((pending['cost'] or 0) + MapRenderingJob.DEFAULT_ESTIMATED_COST *
+            (pending['count'] - pending['estimated']))
+
+def check(job, ip):
+    """Check whether the given new job, submitted from the given IP address,
+    can be queued.
+
+    Returns None if it can, a Refusal otherwise."""
+
+    refusal = None
+
+    max_pending = www.settings.ADMISSION_MAX_PENDING_SECONDS
+    if max_pending:
+        pending = get_pending_seconds()
+        if pending > max_pending:
+            # The queue should be back under the limit once the excess work is
+            # rendered by the workers of the live daemons.
+            workers = max(1, RenderingDaemon.objects.count_workers())
+            refusal = Refusal('busy', max(60, (pending - max_pending) /
+                                          workers))
+
+    if refusal is None and www.settings.ADMISSION_RATE_PER_HOUR:
+        wait = _take_token(ip)
+        if wait:
+            refusal = Refusal('rate', wait)
+
+    if refusal is not None:
+        existing = list(MapRenderingJob.objects
+                        .get_identical(job, statuses=(0, 1))
+                        .order_by('submission_time')[:1])
+        refusal.existing = existing and existing[0] or None
+    return refusal
@@ -39,35 +39,9 @@ def get_latest_blog_posts():
     return f.entries[:4]
 
 def get_osm_database_last_update():
-    """Returns the timestamp of the last PostGIS database update, which is
-    placed into the maposmatic_admin table in the PostGIS database by the
-    planet-update incremental update script."""
-
-    cursor = None
-
-    try:
-        db = gisdb.get()
-        if db is None:
-            return None
-
-        cursor = db.cursor()
-        if cursor is None:
-            return None
-
-        cursor.execute("""select last_update from maposmatic_admin""")
-        last_update = cursor.fetchone()
-        if last_update is None or len(last_update) != 1:
-            return None
-
-        return last_update[0]
-    except:
-        pass
-    finally:
-        # Close the DB cursor if necessary
-        if cursor is not None and not cursor.closed:
-            cursor.close()
-
-    return None
+    """Returns the timestamp of the last PostGIS database update (see
+    gisdb.get_last_update())."""
+    return gisdb.get_last_update()
 
 def all(request):
     # Do not add the useless overhead of parsing blog entries when generating
@@ -0,0 +1,86 @@
+# coding: utf-8
+
+# maposmatic, the web front-end of the MapOSMatic city map generation system
+# Copyright (C) 2009  David Decotigny
+# Copyright (C) 2009  Frédéric Lehobey
+# Copyright (C) 2009  David Mentré
+# Copyright (C) 2009  Maxime Petazzoni
+# Copyright (C) 2009  Thomas Petazzoni
+# Copyright (C) 2009  Gaël Utard
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Download statistics of the rendered maps. The output files are downloaded
+# through the map-download view, which counts the downloads of each job in
+# memory and only flushes the counts to the database every
+# DOWNLOADS_FLUSH_INTERVAL seconds, along with marking the downloaded files as
+# recently used for the renderings garbage collector. Counts not flushed yet
+# when the web front-end process exits are lost.
+
+import logging
+import os
+import threading
+import time
+
+import www.settings
+from www.maposmatic.models import MapRenderingJobDownloads, RenderingFile
+
+l = logging.getLogger('maposmatic')
+
+_lock = threading.Lock()
+_pending = {}
+_last_flush = time.time()
+
+def record(job):
+    """Count a download of the files of the given job."""
+
+    global _pending, _last_flush
+
+    _lock.acquire()
+    try:
+        _pending[job.id] = _pending.get(job.id, 0) + 1
+        if time.time() - _last_flush < www.settings.DOWNLOADS_FLUSH_INTERVAL:
+            return
+        counts = _pending
+        _pending = {}
+        _last_flush = time.time()
+    finally:
+        _lock.release()
+
+    flush(counts)
+
+def _touch(jobids):
+    """Mark the indexed files of the given jobs as recently used."""
+
+    now = time.time()
+    files = RenderingFile.objects.filter(job__in=jobids)
+    for name in files.values_list('name', flat=True):
+        try:
+            os.utime(os.path.join(www.settings.RENDERING_RESULT_PATH, name),
+                     (now, now))
+        except OSError:
+            pass
+    files.update(mtime=now)
+
+def flush(counts):
+    """Write the given download counts, a dictionary of counts by job ID, to
+    the database. Failures are only logged: the download statistics are not
+    worth failing a download."""
+
+    try:
+        MapRenderingJobDownloads.objects.record(counts)
+        _touch(counts.keys())
+    except Exception:
+        l.exception("Could not record the downloads of jobs %s!" %
+                    ', '.join(['#%d' % jobid for jobid in counts]))
@@ -0,0 +1,201 @@
+# coding: utf-8
+
+# maposmatic, the web front-end of the MapOSMatic city map generation system
+# Copyright (C) 2009  David Decotigny
+# Copyright (C) 2009  Frédéric Lehobey
+# Copyright (C) 2009  David Mentré
+# Copyright (C) 2009  Maxime Petazzoni
+# Copyright (C) 2009  Thomas Petazzoni
+# Copyright (C) 2009  Gaël Utard
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Rendering cost estimation. The cost of a job is an estimation of its
+# rendering time, in seconds, computed when the job is submitted from its
+# area, layout, paper size and the density of roads in the area. The rendering
+# daemon uses it to render small jobs first.
+#
+# The rendering timeout of a job is computed from the actual rendering times
+# of similar jobs.
+
+from datetime import datetime, timedelta
+import logging
+
+import ocitysmap
+import www.settings
+from www.maposmatic import gisdb
+from www.maposmatic.models import MapRenderingJob
+
+l = logging.getLogger('maposmatic')
+
+A4_SURFACE_MM2 = 210 * 297
+
+# Linear cost model for each layout: fixed cost, cost per A4 sheet of paper
+# surface, cost per km² of area and cost per road in the area, in seconds.
+COST_MODELS = {
+    'plain':                    (5.0,  3.0, 0.0, 0.002),
+    'single_page_index_side':   (10.0, 3.0, 0.0, 0.004),
+    'single_page_index_bottom': (10.0, 3.0, 0.0, 0.004),
+    'multi_page':               (30.0, 0.0, 2.0, 0.03),
+}
+DEFAULT_COST_MODEL = COST_MODELS['single_page_index_side']
+
+# Average number of roads per km², used when the GIS database is not
+# available to count them.
+DEFAULT_ROAD_DENSITY = 100
+
+# Roads are not counted past this number, to keep the query cheap.
+MAX_ROAD_COUNT = 50000
+
+# Rendering timeouts are computed from the rendering times of (at least
+# TIMEOUT_MIN_SAMPLES and at most TIMEOUT_MAX_SAMPLES) similar jobs rendered
+# in the last TIMEOUT_HISTORY_DAYS days.
+TIMEOUT_MIN_SAMPLES = 5
+TIMEOUT_MAX_SAMPLES = 50
+TIMEOUT_HISTORY_DAYS = 30
+
+def _get_bbox(cursor, job):
+    """Returns the bounding box of the job's area, looking up the
+    administrative boundary in the GIS database if needed, and the SQL
+    expression of this area in the GIS database projection."""
+
+    if job.administrative_osmid:
+        cursor.execute("""select st_astext(st_envelope(st_transform(way,
+                          4002))) from planet_osm_polygon
+                          where osm_id = -%d""" % job.administrative_osmid)
+        result = cursor.fetchone()
+        if result is None:
+            return None, None
+        return (ocitysmap.coords.BoundingBox.parse_wkt(result[0]),
+                """(select st_envelope(way) from planet_osm_polygon
+                    where osm_id = -%d limit 1)""" % job.administrative_osmid)
+
+    bbox = ocitysmap.coords.BoundingBox(job.lat_upper_left,
+                                        job.lon_upper_left,
+                                        job.lat_bottom_right,
+                                        job.lon_bottom_right)
+    return (bbox,
+            """st_transform(st_geomfromtext('%s', 4002), 900913)"""
+            % bbox.as_wkt())
+
+def _count_roads(cursor, area):
+    """Count the roads intersecting the given area's bounding box, using the
+    spatial index only."""
+
+    cursor.execute("""select count(*) from
+                      (select 1 from planet_osm_line
+                       where way && %s and highway is not null
+                       limit %d) as roads""" % (area, MAX_ROAD_COUNT))
+    return cursor.fetchone()[0]
+
+def get_area_info(job):
+    """Returns the area of the job's bounding box, in km², and the number of
+    roads in it, or None for both if the GIS database is not available."""
+
+    db = gisdb.get()
+    if db is None:
+        return None, None
+
+    cursor = db.cursor()
+    try:
+        bbox, area = _get_bbox(cursor, job)
+        if bbox is None:
+            return None, None
+
+        height, width = bbox.spheric_sizes()
+        return width * height / 1e6, _count_roads(cursor, area)
+    except Exception:
+        l.exception("Could not get area information for job '%s'!" %
+                    job.maptitle)
+        db.rollback()
+        return None, None
+    finally:
+        cursor.close()
+
+def estimate_cost(job):
+    """Estimate the rendering time of the given job, in seconds."""
+
+    fixed, per_sheet, per_km2, per_road = \
+        COST_MODELS.get(job.layout, DEFAULT_COST_MODEL)
+    sheets = (float(job.paper_width_mm * job.paper_height_mm) /
+              A4_SURFACE_MM2)
+
+    km2, roads = get_area_info(job)
+    if km2 is None:
+        # Assume a mid-sized town when we know nothing about the area.
+        km2 = 10.0
+    if roads is None:
+        roads = km2 * DEFAULT_ROAD_DENSITY
+
+    return fixed + per_sheet * sheets + per_km2 * km2 + per_road * roads
+
+def _get_similar_jobs(job):
+    """Returns the successful jobs rendered recently, most similar to the given
+    job first: jobs with the same layout, stylesheet, paper size and a
+    comparable cost; then with the same layout and stylesheet; then with the
+    same layout.
+
+    Only the jobs actually rendered are returned, those with recorded
+    rendering timings: jobs served from the rendering cache, or by the
+    rendering of an identical job, took no rendering time of their own."""
+
+    since = datetime.now() - timedelta(TIMEOUT_HISTORY_DAYS)
+    same_layout = (MapRenderingJob.objects
+                   .filter(status__in=(2, 3), resultmsg='ok',
+                           layout=job.layout,
+                           rendering_worker__isnull=False,
+                           timings__isnull=False,
+                           endofrendering_time__gte=since)
+                   .distinct()
+                   .order_by('-endofrendering_time'))
+    same_style = same_layout.filter(stylesheet=job.stylesheet)
+
+    candidates = [same_style, same_layout]
+    if job.estimated_cost:
+        candidates.insert(0, same_style.filter(
+            paper_width_mm=job.paper_width_mm,
+            paper_height_mm=job.paper_height_mm,
+            estimated_cost__range=(job.estimated_cost / 2,
+                                   job.estimated_cost * 2)))
+
+    for jobs in candidates:
+        jobs = list(jobs[:TIMEOUT_MAX_SAMPLES])
+        if len(jobs) >= TIMEOUT_MIN_SAMPLES:
+            return jobs
+    return []
+
+def estimate_timeout(job):
+    """Compute the rendering timeout of the given job, in seconds, from the
+    95th percentile of the rendering times of similar jobs, scaled by their
+    estimated costs, or from the job's estimated cost when there's not
+    enough history. The timeout is kept between DAEMON_RENDER_TIMEOUT_MIN
+    and DAEMON_RENDER_TIMEOUT_MAX."""
+
+    durations = []
+    for similar in _get_similar_jobs(job):
+        delta = similar.endofrendering_time - similar.startofrendering_time
+        duration = delta.days * 86400 + delta.seconds
+        if job.estimated_cost and similar.estimated_cost:
+            duration *= job.estimated_cost / similar.estimated_cost
+        durations.append(duration)
+
+    if durations:
+        durations.sort()
+        expected = durations[int(0.95 * (len(durations) - 1))]
+    else:
+        expected = job.estimated_cost or estimate_cost(job)
+
+    timeout = int(expected * www.settings.DAEMON_RENDER_TIMEOUT_FACTOR)
+    return max(www.settings.DAEMON_RENDER_TIMEOUT_MIN,
+               min(www.settings.DAEMON_RENDER_TIMEOUT_MAX, timeout))
@@ -0,0 +1,107 @@
+# coding: utf-8
+
+# maposmatic, the web front-end of the MapOSMatic city map generation system
+# Copyright (C) 2009  David Decotigny
+# Copyright (C) 2009  Frédéric Lehobey
+# Copyright (C) 2009  David Mentré
+# Copyright (C) 2009  Maxime Petazzoni
+# Copyright (C) 2009  Thomas Petazzoni
+# Copyright (C) 2009  Gaël Utard
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Queue ETA estimation. The start and end of rendering of all the queued jobs
+# are estimated at once, by simulating the rendering of the queue by the
+# active rendering workers of the live daemons (see RenderingDaemon), with the rendering time of each job predicted from the
+# per-layout rendering statistics maintained by the daemon (see
+# RenderingDurationStats). The estimates are cached for a few seconds.
+
+from datetime import datetime, timedelta
+import heapq
+
+from django.core.cache import cache
+
+from www.maposmatic.models import MapRenderingJob, RenderingDaemon
+from www.maposmatic.models import RenderingDurationStats
+
+CACHE_KEY = 'maposmatic-queue-eta'
+CACHE_SECONDS = 10
+
+class QueueEstimates:
+    """
+    The estimated start and end of rendering of the waiting and rendering
+    jobs, and the position of the waiting jobs in the queue.
+    """
+
+    def __init__(self):
+        self.times = {}
+        self.positions = {}
+        self.queue_size = 0
+
+    def get_start(self, job):
+        return self.times.get(job.id, (None, None))[0]
+
+    def get_end(self, job):
+        return self.times.get(job.id, (None, None))[1]
+
+    def get_position(self, job):
+        return self.positions.get(job.id, 0)
+
+def compute(now=None):
+    """Compute the estimates for the whole queue in one pass."""
+
+    now = now or datetime.now()
+    stats = dict([(s.layout, s) for s in RenderingDurationStats.objects.all()])
+    jobs = list(MapRenderingJob.objects.filter(status__in=(0, 1)))
+    rendering = [job for job in jobs if job.is_rendering()]
+    waiting = [job for job in jobs if job.is_waiting()]
+
+    estimates = QueueEstimates()
+    estimates.queue_size = len(waiting)
+
+    # Time at which each worker will be free to render another job. Jobs
+    # running late are expected to end soon.
+    workers = []
+    for job in rendering:
+        end = job.startofrendering_time + timedelta(
+            seconds=RenderingDurationStats.objects.predict(job, stats))
+        end = max(end, now + timedelta(seconds=1))
+        estimates.times[job.id] = (job.startofrendering_time, end)
+        workers.append(end)
+    # Without a live daemon, the queue is estimated as if a single worker
+    # was rendering it.
+    active = max(1, RenderingDaemon.objects.count_workers())
+    workers += [now] * max(0, active - len(workers))
+    heapq.heapify(workers)
+
+    for position, job in enumerate(MapRenderingJob.objects.schedule(waiting,
+                                                                    now)):
+        start = heapq.heappop(workers)
+        end = start + timedelta(
+            seconds=RenderingDurationStats.objects.predict(job, stats))
+        heapq.heappush(workers, end)
+        estimates.times[job.id] = (start, end)
+        estimates.positions[job.id] = position + 1
+
+    return estimates
+
+def get():
+    """Returns the queue estimates, computing them at most every
+    CACHE_SECONDS seconds."""
+
+    estimates = cache.get(CACHE_KEY)
+    if estimates is None:
+        estimates = compute()
+        cache.set(CACHE_KEY, estimates, CACHE_SECONDS)
+    return estimates
@@ -52,3 +52,53 @@ def get():
         _DB = None
 
     return _DB
+
+def _reset():
+    """Forget the connection to the PostGIS database, after it was lost, so
+    that the next get() reconnects."""
+    global _DB
+
+    try:
+        if _DB:
+            _DB.close()
+    except Exception:
+        pass
+    _DB = None
+
+def get_last_update():
+    """Returns the timestamp of the last PostGIS database update, which is
+    placed into the maposmatic_admin table in the PostGIS database by the
+    planet-update incremental update script, or None if it is not
+    available."""
+
+    db = get()
+    if db is None:
+        return None
+
+    cursor = None
+    try:
+        cursor = db.cursor()
+        cursor.execute("""select last_update from maposmatic_admin""")
+        last_update = cursor.fetchone()
+        # Don't leave the connection idle in transaction.
+        db.rollback()
+        if last_update is None or len(last_update) != 1:
+            return None
+        return last_update[0]
+    except Exception, e:
+        l.warning("Could not get the PostGIS database last update: %s" %
+                  str(e).strip())
+        if isinstance(e, (psycopg2.InterfaceError, psycopg2.OperationalError)):
+            _reset()
+        else:
+            try:
+                db.rollback()
+            except Exception:
+                _reset()
+        return None
+    finally:
+        try:
+            if cursor is not None and not cursor.closed:
+                cursor.close()
+        except Exception:
+            pass
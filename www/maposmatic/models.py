@@ -22,11 +22,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Q, Sum
 from django.utils.translation import ugettext_lazy as _
 
 from datetime import datetime, timedelta
 import www.settings
+import glob
 import re
 import os
 
@@ -36,6 +38,56 @@ class MapRenderingJobManager(models.Manager):
     def to_render(self):
         return MapRenderingJob.objects.filter(status=0).order_by('submission_time')
 
+    def schedule(self, jobs, now=None):
+        """Returns the given waiting jobs sorted in rendering order: shortest
+        estimated job first, with the waiting time of each job reducing its
+        estimated cost by DAEMON_SCHEDULING_AGING so that expensive jobs
+        don't wait forever."""
+
+        now = now or datetime.now()
+        return sorted(jobs, key=lambda job: job.scheduling_priority(now))
+
+    def renew_leases(self, worker, jobids):
+        """Renew the leases of the given jobs, being rendered by the given
+        worker. Jobs the worker claimed but doesn't render anymore are left
+        alone, so that their lease expires and they go back in the queue."""
+        if not jobids:
+            return 0
+        return (MapRenderingJob.objects.filter(id__in=list(jobids), status=1,
+                                               rendering_worker=worker)
+                .update(heartbeat_time=datetime.now()))
+
+    def reap_expired_leases(self):
+        """Put the jobs whose lease expired, because their worker died or
+        lost touch with the database, back in the queue.
+
+        Returns the number of jobs put back in the queue."""
+
+        expired = datetime.now() - timedelta(
+            seconds=www.settings.DAEMON_LEASE_DURATION)
+        return (MapRenderingJob.objects
+                .filter(Q(heartbeat_time__lt=expired) |
+                        Q(heartbeat_time__isnull=True), status=1)
+                .update(status=0, rendering_worker=None,
+                        heartbeat_time=None))
+
+    def get_identical(self, job, statuses=(0,)):
+        """Returns the jobs with one of the given statuses (by default, the
+        waiting jobs) asking for the exact same rendering as the given
+        job."""
+        return (MapRenderingJob.objects
+                .filter(status__in=statuses, maptitle=job.maptitle,
+                        administrative_osmid=job.administrative_osmid,
+                        lat_upper_left=job.lat_upper_left,
+                        lon_upper_left=job.lon_upper_left,
+                        lat_bottom_right=job.lat_bottom_right,
+                        lon_bottom_right=job.lon_bottom_right,
+                        stylesheet=job.stylesheet, layout=job.layout,
+                        paper_width_mm=job.paper_width_mm,
+                        paper_height_mm=job.paper_height_mm,
+                        map_language=job.map_language)
+                .exclude(id=job.id))
+
     def queue_size(self):
         return MapRenderingJob.objects.filter(status=0).count()
 
@@ -67,6 +119,32 @@ class MapRenderingJobManager(models.Manager):
 
         return None
 
+    def get_by_filenames(self, names):
+        """Like get_by_filename(), for many files at once, with a single
+        query.
+
+        Returns a dictionary of the parent jobs found, by file name."""
+
+        jobids = {}
+        for name in names:
+            try:
+                jobids[name] = int(name.split('_', 1)[0])
+            except ValueError:
+                pass
+
+        # Keep the queries within the limits of the number of parameters.
+        ids = list(set(jobids.values()))
+        jobs = {}
+        for i in range(0, len(ids), 500):
+            jobs.update(MapRenderingJob.objects.in_bulk(ids[i:i+500]))
+
+        found = {}
+        for name, jobid in jobids.items():
+            job = jobs.get(jobid)
+            if job and name.startswith(job.files_prefix()):
+                found[name] = job
+        return found
+
 SPACE_REDUCE = re.compile(r"\s+")
 NONASCII_REMOVE = re.compile(r"[^A-Za-z0-9]+")
 
@@ -82,6 +160,9 @@ class MapRenderingJob(models.Model):
 
     NONCE_SIZE = 16
 
+    # Estimated rendering time of the jobs queued without an estimation
+    DEFAULT_ESTIMATED_COST = 60
+
     maptitle = models.CharField(max_length=256)
     stylesheet = models.CharField(max_length=256)
     layout = models.CharField(max_length=256)
@@ -109,6 +190,33 @@ class MapRenderingJob(models.Model):
     index_queue_at_submission = models.IntegerField()
     map_language = models.CharField(max_length=16)
 
+    # Estimated rendering time, in seconds, and rendering timeout (see
+    # www.maposmatic.estimate)
+    estimated_cost = models.FloatField(blank=True, null=True)
+    render_timeout = models.IntegerField(blank=True, null=True)
+
+    # Rendering lease: the worker rendering the job, and the last time it
+    # renewed its lease on the job.
+    rendering_worker = models.CharField(max_length=128, blank=True, null=True)
+    heartbeat_time = models.DateTimeField(blank=True, null=True)
+
+    # Rendering progress, reported by the rendering daemon: the current
+    # rendering stage, the number of steps of this stage done out of its total
+    # number of steps (when known), and the overall progress, in percent.
+    progress_stage = models.CharField(max_length=32, blank=True, null=True)
+    progress_done = models.IntegerField(blank=True, null=True)
+    progress_total = models.IntegerField(blank=True, null=True)
+    progress_percent = models.IntegerField(blank=True, null=True)
+
+    # Whether the job went over the rendering memory limit, and must be
+    # rendered with the large job memory limit.
+    large = models.BooleanField(default=False)
+
+    # Key of the rendering in the rendered output cache (see
+    # www.maposmatic.rendercache)
+    render_key = models.CharField(max_length=40, blank=True, null=True,
+                                  db_index=True)
+
     nonce = models.CharField(max_length=NONCE_SIZE, blank=True)
 
     objects = MapRenderingJobManager()
@@ -129,16 +237,80 @@ class MapRenderingJob(models.Model):
              self.maptitle_computized())
 
 
-    def start_rendering(self):
+    def start_rendering(self, worker):
+        """Claim this job for rendering on behalf of the given worker. The job
+        is moved from the waiting state to the rendering state with a single
+        conditional update, so that when several workers race for the same
+        job, only one of them gets it. The worker then holds a lease on the
+        job, that it must renew (see MapRenderingJobManager.renew_leases())
+        while rendering.
+
+        Returns True if the job was claimed, False otherwise."""
+
+        now = datetime.now()
+        claimed = (MapRenderingJob.objects.filter(id=self.id, status=0)
+                   .update(status=1, startofrendering_time=now,
+                           rendering_worker=worker, heartbeat_time=now))
+        if not claimed:
+            return False
+
         self.status = 1
-        self.startofrendering_time = datetime.now()
-        self.save()
+        self.startofrendering_time = now
+        self.rendering_worker = worker
+        self.heartbeat_time = now
+        return True
 
     def end_rendering(self, resultmsg):
+        """Mark the job as rendered, unless its worker lost its lease on the
+        job in the mean time.
+
+        Returns True if the job was updated, False otherwise."""
+
+        now = datetime.now()
+        ended = (MapRenderingJob.objects
+                 .filter(id=self.id, status=1,
+                         rendering_worker=self.rendering_worker)
+                 .update(status=2, endofrendering_time=now,
+                         resultmsg=resultmsg))
+        if not ended:
+            return False
+
         self.status = 2
-        self.endofrendering_time = datetime.now()
+        self.endofrendering_time = now
         self.resultmsg = resultmsg
-        self.save()
+        return True
+
+    def set_progress(self, stage, done, total, percent):
+        """Record the rendering progress of this job, as long as it's
+        rendering."""
+        self.progress_stage = stage
+        self.progress_done = done
+        self.progress_total = total
+        self.progress_percent = percent
+        MapRenderingJob.objects.filter(id=self.id, status=1).update(
+            progress_stage=stage, progress_done=done, progress_total=total,
+            progress_percent=percent)
+
+    def set_render_key(self, key):
+        self.render_key = key
+        MapRenderingJob.objects.filter(id=self.id).update(render_key=key)
+
+    def set_render_timeout(self, timeout):
+        self.render_timeout = timeout
+        MapRenderingJob.objects.filter(id=self.id).update(
+            render_timeout=timeout)
+
+    def scheduling_priority(self, now):
+        """Returns the scheduling priority of this job at the given time; the
+        lower, the sooner the job gets rendered."""
+
+        cost = self.estimated_cost
+        if cost is None:
+            cost = self.DEFAULT_ESTIMATED_COST
+
+        waited = now - self.submission_time
+        return (cost - www.settings.DAEMON_SCHEDULING_AGING *
+                (waited.days * 86400 + waited.seconds))
 
     def rendering_time_gt_1min(self):
         if self.needs_waiting():
@@ -173,9 +345,24 @@ class MapRenderingJob(models.Model):
     def get_map_fileurl(self, format):
         return www.settings.RENDERING_RESULT_URL + "/" + self.files_prefix() + "." + format
 
+    def get_map_downloadurl(self, format):
+        """Returns the URL through which the file of the given format is
+        downloaded, counting the downloads of this job's files."""
+        return reverse('map-download', args=[self.id, format])
+
     def get_map_filepath(self, format):
         return os.path.join(www.settings.RENDERING_RESULT_PATH, self.files_prefix() + "." + format)
 
+    def get_index_filepath(self):
+        """Returns the path of the CSV index of this job, gzipped if it was
+        moved to the cold tier, or None if it's not available."""
+
+        path = self.get_map_filepath('csv')
+        for candidate in (path, path + '.gz'):
+            if os.path.exists(candidate):
+                return candidate
+        return None
+
     def output_files(self):
         """Returns a structured dictionary of the output files for this job.
         The result contains two lists, 'maps' and 'indeces', listing the output
@@ -188,15 +375,16 @@ class MapRenderingJob(models.Model):
             if format != 'csv' and os.path.exists(map_path):
                 # Map files (all formats but CSV)
                 allfiles['maps'][format] = (
-                    self.get_map_fileurl(format),
+                    self.get_map_downloadurl(format),
                     _("%(title)s %(format)s Map") % {'title': self.maptitle,
                                                      'format': format.upper()},
                     os.stat(map_path).st_size,
                     map_path)
-            elif format == 'csv' and os.path.exists(map_path):
-                # Index CSV file
+            elif format == 'csv' and self.get_index_filepath():
+                # Index CSV file, possibly gzipped in the cold tier
+                map_path = self.get_index_filepath()
                 allfiles['indeces'][format] = (
-                    self.get_map_fileurl(format),
+                    self.get_map_downloadurl(format),
                      _("%(title)s %(format)s Index") % {'title': self.maptitle,
                                                        'format': format.upper()},
                     os.stat(map_path).st_size,
@@ -208,6 +396,28 @@ class MapRenderingJob(models.Model):
 
         return allfiles
 
+    def link_files(self, source):
+        """Publish the output files of the given source job as this job's
+        files, using hard links.
+
+        Returns the number of files linked."""
+
+        source_prefix = os.path.join(www.settings.RENDERING_RESULT_PATH,
+                                     source.files_prefix())
+        prefix = os.path.join(www.settings.RENDERING_RESULT_PATH,
+                              self.files_prefix())
+
+        linked = 0
+        for path in glob.glob(source_prefix + '*'):
+            os.link(path, prefix + path[len(source_prefix):])
+            linked += 1
+
+        # The files of the source job are now shared, and take less of its
+        # share of the space.
+        RenderingFile.objects.add_job(self)
+        RenderingFile.objects.add_job(source)
+        return linked
+
     def has_output_files(self):
         """This function tells whether this job still has its output files
         available on the rendering storage.
@@ -237,15 +447,50 @@ class MapRenderingJob(models.Model):
             except OSError:
                 pass
 
-        self.status = 3
-        self.save()
+        RenderingFile.objects.remove_job(self)
+
+        # Without its files, the rendering of a done job can't be served
+        # from the cache anymore. Jobs in any other state, like a rendering
+        # job cleaning up after a failure, are left alone.
+        if (MapRenderingJob.objects.filter(id=self.id, status=2)
+            .update(status=3, render_key=None)):
+            self.status = 3
+            self.render_key = None
         return removed, saved
 
     def cancel(self):
+        """Cancel this job, if it's waiting or rendering. A rendering job is
+        stopped by the rendering daemon when it notices the cancellation (see
+        was_cancelled()).
+
+        Returns True if the job was cancelled, False otherwise."""
+
+        now = datetime.now()
+        cancelled = (MapRenderingJob.objects
+                     .filter(id=self.id, status__in=(0, 1))
+                     .update(status=4, endofrendering_time=now,
+                             resultmsg='rendering cancelled'))
+        if not cancelled:
+            return False
+
         self.status = 4
-        self.endofrendering_time = datetime.now()
+        self.endofrendering_time = now
         self.resultmsg = 'rendering cancelled'
-        self.save()
+        return True
+
+    def was_cancelled(self):
+        """Returns True if this job was cancelled, checking its current status
+        in the database."""
+        return MapRenderingJob.objects.filter(id=self.id, status=4).exists()
+
+    def requeue(self):
+        """Put this job, claimed for rendering but not rendered, back in the
+        queue."""
+        (MapRenderingJob.objects
+         .filter(id=self.id, status=1,
+                 rendering_worker=self.rendering_worker)
+         .update(status=0, startofrendering_time=None, rendering_worker=None,
+                 heartbeat_time=None, large=self.large))
 
     def get_thumbnail(self):
         if self.is_waiting() or self.is_cancelled():
@@ -257,19 +502,424 @@ class MapRenderingJob(models.Model):
             return thumbnail_url
         return None
 
+    # Position of the job in the scheduled queue, that is in the order in
+    # which the jobs are actually rendered (see www.maposmatic.eta)
     def current_position_in_queue(self):
-        return MapRenderingJob.objects.filter(status=0).filter(id__lte=self.id).count()
+        from www.maposmatic import eta
+        return eta.get().get_position(self)
 
-    # Estimate the date at which the rendering will be started
+    # Estimate the date at which the rendering will be started and completed
+    # (see www.maposmatic.eta)
     def rendering_estimated_start_time(self):
-        waiting_time = datetime.now() - self.submission_time
-        progression = self.index_queue_at_submission - self.current_position_in_queue()
-        if progression == 0:
-            return datetime.now()
-        mean_job_rendering_time = waiting_time // progression
-        estimated_time_left = mean_job_rendering_time * self.current_position_in_queue()
-        return datetime.now() + estimated_time_left
+        from www.maposmatic import eta
+        return eta.get().get_start(self)
+
+    def rendering_estimated_end_time(self):
+        from www.maposmatic import eta
+        return eta.get().get_end(self)
+
+    def record_timings(self, timings):
+        """Record the time spent in each rendering stage, given as a list of
+        (stage, seconds) tuples."""
+        for stage, duration in timings:
+            MapRenderingJobTiming(job=self, stage=stage,
+                                  duration=duration).save()
+
+    def get_timings(self):
+        return self.timings.order_by('id')
+
+    def record_usage(self, usage):
+        """Record the resources used by the rendering of this job, given as a
+        dictionary of MapRenderingJobUsage fields, along with the size of its
+        output files."""
+
+        files = self.output_files()
+        output_size = sum([f[2] for f in files['maps'].values() +
+                           files['indeces'].values()])
+        MapRenderingJobUsage(job=self, output_size=output_size,
+                             **usage).save()
 
     def get_absolute_url(self):
         return reverse('map-by-id', args=[self.id])
 
+class MapRenderingJobTiming(models.Model):
+    """
+    The time spent by the rendering of a job in one of the rendering stages
+    (renderer setup, data preparation, rendering of each output format,
+    thumbnail creation, publication of the files).
+    """
+
+    job = models.ForeignKey(MapRenderingJob, related_name='timings')
+    stage = models.CharField(max_length=32)
+    duration = models.FloatField()
+
+
+class MapRenderingJobDownloadsManager(models.Manager):
+    def record(self, counts, now=None):
+        """Account the given numbers of downloads, a dictionary of counts by
+        job ID, in the download statistics of these jobs."""
+
+        now = now or datetime.now()
+        for jobid, count in counts.items():
+            if not self.filter(job__id=jobid).update(
+                    count=F('count') + count, last_download_time=now):
+                MapRenderingJobDownloads(job_id=jobid, count=count,
+                                         last_download_time=now).save()
+
+class MapRenderingJobDownloads(models.Model):
+    """
+    The number of downloads of the output files of a job, and the time of the
+    last one, used to keep popular renderings around (see
+    RenderingFileManager.evict()).
+    """
+
+    job = models.OneToOneField(MapRenderingJob, related_name='downloads')
+    count = models.IntegerField()
+    last_download_time = models.DateTimeField()
+
+    objects = MapRenderingJobDownloadsManager()
+
+class MapRenderingJobUsage(models.Model):
+    """
+    The resources used by the rendering of a job: user and system CPU time,
+    in seconds, peak resident memory, in KiB, blocks read and written, and the
+    total size of the output files, in bytes.
+
+    The peak memory of a job rendered by a long-lived rendering worker is
+    only known if it's the highest of the worker so far, and None otherwise.
+    """
+
+    job = models.OneToOneField(MapRenderingJob, related_name='usage')
+    cpu_user = models.FloatField()
+    cpu_system = models.FloatField()
+    max_rss_kb = models.IntegerField(null=True)
+    blocks_in = models.IntegerField()
+    blocks_out = models.IntegerField()
+    output_size = models.BigIntegerField()
+
+
+class RenderingDurationStatsManager(models.Manager):
+    def record(self, job, duration):
+        """Account the rendering time, in seconds, of the given successfully
+        rendered job in the statistics of its layout."""
+
+        stats, created = self.get_or_create(
+            layout=job.layout, defaults={'count': 0, 'mean_duration': duration})
+        weight = 1.0 / min(stats.count + 1, RenderingDurationStats.WINDOW)
+
+        updates = {'count': F('count') + 1,
+                   'mean_duration': (F('mean_duration') * (1 - weight) +
+                                     duration * weight)}
+        if job.estimated_cost:
+            ratio = duration / job.estimated_cost
+            if stats.cost_ratio is None:
+                updates['cost_ratio'] = ratio
+            else:
+                updates['cost_ratio'] = (F('cost_ratio') * (1 - weight) +
+                                         ratio * weight)
+
+        self.filter(id=stats.id).update(**updates)
+
+    def predict(self, job, stats=None):
+        """Predict the rendering time of the given job, in seconds, from the
+        statistics of its layout. The statistics of all layouts can be given
+        as a dictionary, to save the queries when predicting many jobs."""
+
+        if stats is None:
+            stats = dict([(s.layout, s)
+                          for s in self.filter(layout=job.layout)])
+
+        layout = stats.get(job.layout)
+        if layout and job.estimated_cost and layout.cost_ratio:
+            return job.estimated_cost * layout.cost_ratio
+        if layout:
+            return layout.mean_duration
+        return job.estimated_cost or MapRenderingJob.DEFAULT_ESTIMATED_COST
+
+class RenderingDurationStats(models.Model):
+    """
+    Rolling rendering time statistics of a layout: the mean rendering time,
+    and the mean ratio between the actual and estimated rendering times. Both
+    are moving averages over about the last WINDOW jobs.
+    """
+
+    WINDOW = 100
+
+    layout = models.CharField(max_length=256, unique=True)
+    count = models.IntegerField()
+    mean_duration = models.FloatField()
+    cost_ratio = models.FloatField(null=True)
+
+    objects = RenderingDurationStatsManager()
+
+class RenderingFileManager(models.Manager):
+    def _adjust_total(self, delta):
+        """Adjust the total size of the indexed files by delta bytes."""
+        if not delta:
+            return
+        if not RenderingStorage.objects.filter(id=1).update(
+                size=F('size') + delta):
+            RenderingStorage(id=1, size=delta).save()
+
+    def get_total_size(self):
+        """Returns the total size of the indexed files, in bytes."""
+        try:
+            return RenderingStorage.objects.get(id=1).size
+        except RenderingStorage.DoesNotExist:
+            return 0
+
+    def add(self, path, job=None, cold=None):
+        """Index the given file of RENDERING_RESULT_PATH, or update its
+        entry. Its cold tier flag is left alone unless given."""
+
+        s = os.stat(path)
+        # Files hard-linked between jobs only account for their share of the
+        # space they use.
+        size = s.st_size / s.st_nlink
+        name = os.path.basename(path)
+
+        try:
+            f = self.get(name=name)
+            self._adjust_total(size - f.size)
+            if cold is None:
+                cold = f.cold
+            self.filter(id=f.id).update(size=size, mtime=s.st_mtime, job=job,
+                                        cold=cold)
+        except RenderingFile.DoesNotExist:
+            try:
+                RenderingFile(name=name, size=size, mtime=s.st_mtime,
+                              job=job, cold=bool(cold)).save()
+            except IntegrityError:
+                # Indexed in the mean time by a reconciliation, try again.
+                transaction.rollback_unless_managed()
+                return self.add(path, job, cold)
+            self._adjust_total(size)
+
+    def get_demotable(self, before, count):
+        """Returns at most count jobs whose rendering has indexed files not in
+        the cold tier yet, last changed before the given timestamp."""
+
+        jobids = (self.filter(cold=False, mtime__lt=before, job__isnull=False)
+                  .order_by().values_list('job', flat=True).distinct()[:count])
+        return MapRenderingJob.objects.filter(id__in=list(jobids))
+
+    def add_job(self, job):
+        """Index the published output files of the given job, except its
+        thumbnail."""
+
+        prefix = os.path.join(www.settings.RENDERING_RESULT_PATH,
+                              job.files_prefix())
+        for path in glob.glob(prefix + '*'):
+            if not path.endswith(RenderingFile.THUMBNAIL_SUFFIX):
+                self.add(path, job)
+
+    def remove(self, name):
+        """Remove the given file from the index."""
+        files = self.filter(name=name)
+        size = files.aggregate(size=Sum('size'))['size'] or 0
+        files.delete()
+        self._adjust_total(-size)
+
+    def remove_job(self, job):
+        """Remove the files of the given job from the index."""
+        files = self.filter(job=job)
+        size = files.aggregate(size=Sum('size'))['size'] or 0
+        files.delete()
+        self._adjust_total(-size)
+
+    def get_eviction_score(self, job, files, downloads, stats):
+        """Returns the eviction score of the rendering of the given job, from
+        its files, its number of downloads and the rendering statistics: the
+        rendering time it would take to render it again, weighted by its
+        popularity, per byte it uses. Renderings with the lowest scores are
+        evicted first."""
+
+        size = sum([f.size for f in files])
+        cost = RenderingDurationStats.objects.predict(job, stats)
+        return cost * (1 + downloads) / max(size, 1)
+
+    def evict(self, needed, count):
+        """Remove the least valuable of the oldest renderings from the disk and
+        from the index, until at least needed bytes are saved, considering at
+        most the count oldest indexed files. Among them, orphan files go first,
+        then the renderings with the lowest eviction score (see
+        get_eviction_score()). All the files of a job are removed together,
+        and the job is marked as rendered without files.
+
+        Returns the list of (job id, removed file names, saved bytes) of the
+        evicted renderings, with a None job id for the orphan files."""
+
+        oldest = list(self.order_by('mtime')[:count])
+
+        # Group the files by job, in the order of their oldest file. Orphan
+        # files each make their own group.
+        order = []
+        groups = {}
+        for f in oldest:
+            if f.job_id:
+                key = ('job', f.job_id)
+            else:
+                key = ('file', f.id)
+            if key not in groups:
+                groups[key] = not f.job_id and [f] or []
+                order.append(key)
+
+        jobids = [key[1] for key in order if key[0] == 'job']
+        if jobids:
+            for f in self.filter(job__in=jobids):
+                groups[('job', f.job_id)].append(f)
+
+            # Rank the renderings, orphan files first, keeping the oldest
+            # first for equal scores.
+            jobs = MapRenderingJob.objects.in_bulk(jobids)
+            downloads = dict(MapRenderingJobDownloads.objects
+                             .filter(job__in=jobids)
+                             .values_list('job', 'count'))
+            stats = dict([(s.layout, s) for s in
+                          RenderingDurationStats.objects.all()])
+            scores = {}
+            for key in order:
+                if key[0] == 'job' and key[1] in jobs:
+                    scores[key] = self.get_eviction_score(
+                        jobs[key[1]], groups[key],
+                        downloads.get(key[1], 0), stats)
+                else:
+                    scores[key] = 0
+            order.sort(key=lambda key: scores[key])
+
+        evicted = []
+        ids = []
+        saved = 0
+        for key in order:
+            if saved >= needed:
+                break
+
+            names = []
+            for f in groups[key]:
+                try:
+                    os.remove(os.path.join(www.settings.RENDERING_RESULT_PATH,
+                                           f.name))
+                    names.append(f.name)
+                except OSError:
+                    pass
+                ids.append(f.id)
+                saved += f.size
+            evicted.append((key[0] == 'job' and key[1] or None, names,
+                            sum([f.size for f in groups[key]])))
+
+        if ids:
+            self.filter(id__in=ids).delete()
+            self._adjust_total(-saved)
+
+        # Without their files, the renderings can't be served from the cache
+        # anymore.
+        obsolete = [jobid for jobid, names, size in evicted if jobid]
+        if obsolete:
+            MapRenderingJob.objects.filter(id__in=obsolete, status=2).update(
+                status=3, render_key=None)
+        return evicted
+
+    def reconcile(self, files):
+        """Make the index match the given list of (path, job) files, actually
+        present in RENDERING_RESULT_PATH, and recompute the total size of the
+        indexed files.
+
+        Returns the number of entries added, updated and removed."""
+
+        indexed = dict([(f.name, f) for f in self.all()])
+        added = updated = 0
+
+        for path, job in files:
+            name = os.path.basename(path)
+            f = indexed.pop(name, None)
+            try:
+                s = os.stat(path)
+            except OSError:
+                continue
+
+            size = s.st_size / s.st_nlink
+            if f is None:
+                try:
+                    RenderingFile(name=name, size=size, mtime=s.st_mtime,
+                                  job=job).save()
+                    added += 1
+                except IntegrityError:
+                    # Indexed in the mean time, when it was published.
+                    transaction.rollback_unless_managed()
+            elif f.size != size or f.mtime != s.st_mtime:
+                self.filter(id=f.id).update(size=size, mtime=s.st_mtime)
+                updated += 1
+
+        # Whatever is left in the index is gone from the disk, unless it was
+        # published after the directory was listed.
+        gone = [f.id for f in indexed.values() if not os.path.exists(
+                os.path.join(www.settings.RENDERING_RESULT_PATH, f.name))]
+        for i in range(0, len(gone), 500):
+            self.filter(id__in=gone[i:i+500]).delete()
+
+        total = self.aggregate(size=Sum('size'))['size'] or 0
+        if not RenderingStorage.objects.filter(id=1).update(size=total):
+            RenderingStorage(id=1, size=total).save()
+        return added, updated, len(gone)
+
+class RenderingFile(models.Model):
+    """
+    An entry of the index of the files of RENDERING_RESULT_PATH, used by the
+    renderings garbage collector of the daemon instead of listing and
+    checking all the files. Files are indexed when they are published, and
+    removed from the index when they are removed. The index is regularly
+    reconciled with the actual directory contents. Files recompressed to the
+    cold tier (see scripts/coldstorage.py) are flagged as cold.
+    """
+
+    THUMBNAIL_SUFFIX = '_small.png'
+
+    name = models.CharField(max_length=256, unique=True)
+    job = models.ForeignKey(MapRenderingJob, null=True,
+                            related_name='indexed_files')
+    size = models.BigIntegerField()
+    mtime = models.FloatField(db_index=True)
+    cold = models.BooleanField(default=False)
+
+    objects = RenderingFileManager()
+
+class RenderingStorage(models.Model):
+    """
+    The total size of the files indexed by RenderingFile, in bytes, kept up
+    to date as files are indexed and removed from the index.
+    """
+
+    size = models.BigIntegerField()
+
+class RenderingDaemonManager(models.Manager):
+    def heartbeat(self, worker, workers):
+        """Record that the rendering daemon named worker is alive, with the
+        given number of active rendering workers."""
+
+        now = datetime.now()
+        # Only the daemon itself records its heartbeats.
+        if not self.filter(worker=worker).update(workers=workers,
+                                                 heartbeat_time=now):
+            self.create(worker=worker, workers=workers, heartbeat_time=now)
+
+    def count_workers(self):
+        """Returns the number of active rendering workers of the live
+        rendering daemons, that recorded a heartbeat within the last lease
+        duration."""
+
+        alive = datetime.now() - timedelta(
+            seconds=www.settings.DAEMON_LEASE_DURATION)
+        return (self.filter(heartbeat_time__gte=alive)
+                .aggregate(workers=Sum('workers'))['workers'] or 0)
+
+class RenderingDaemon(models.Model):
+    """
+    The rendering daemons, with their number of active rendering workers,
+    recorded periodically by each daemon (see RenderingDaemonManager).
+    """
+
+    worker = models.CharField(max_length=128, unique=True)
+    workers = models.IntegerField()
+    heartbeat_time = models.DateTimeField()
+
+    objects = RenderingDaemonManager()
@@ -0,0 +1,141 @@
+# coding: utf-8
+
+# maposmatic, the web front-end of the MapOSMatic city map generation system
+# Copyright (C) 2009  David Decotigny
+# Copyright (C) 2009  Frédéric Lehobey
+# Copyright (C) 2009  David Mentré
+# Copyright (C) 2009  Maxime Petazzoni
+# Copyright (C) 2009  Thomas Petazzoni
+# Copyright (C) 2009  Gaël Utard
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Rendered output cache. Each rendering is keyed on a hash of the parameters
+# that determine its output and of the version of the GIS data it was rendered
+# from (the last PostGIS database update). A job submitted with the key of a
+# rendering whose files are still available is served by publishing these
+# files, as hard links, instead of being queued for rendering.
+#
+# The cache holds the renderings still on the rendering storage: it is evicted
+# by the renderings garbage collector of the daemon, least recently used
+# renderings first, since cache hits touch the files they reuse, weighted by
+# their popularity and rendering cost.
+
+from datetime import datetime
+import glob
+import hashlib
+import logging
+import os
+import time
+
+import www.settings
+from www.maposmatic import gisdb
+from www.maposmatic.models import MapRenderingJob, RenderingFile
+
+l = logging.getLogger('maposmatic')
+
+# The job fields that determine the output of its rendering.
+KEY_FIELDS = ('maptitle', 'administrative_osmid',
+              'lat_upper_left', 'lon_upper_left',
+              'lat_bottom_right', 'lon_bottom_right',
+              'stylesheet', 'layout', 'paper_width_mm', 'paper_height_mm',
+              'map_language')
+
+def get_key(job, data_version=None):
+    """Returns the cache key of the given job's rendering, or None if the
+    version of the GIS data is not known."""
+
+    data_version = data_version or gisdb.get_last_update()
+    if data_version is None:
+        return None
+
+    values = [u'%s=%s' % (field, getattr(job, field)) for field in KEY_FIELDS]
+    values.append('data=%s' % data_version.isoformat())
+    return hashlib.sha1('\n'.join(values).encode('utf-8')).hexdigest()
+
+def lookup(key):
+    """Returns the most recent successful rendering with the given key whose
+    files are still available, or None."""
+
+    if key is None:
+        return None
+
+    for job in (MapRenderingJob.objects
+                .filter(status=2, resultmsg='ok', render_key=key)
+                .order_by('-endofrendering_time')[:5]):
+        if job.has_output_files():
+            return job
+    return None
+
+def _touch(job):
+    """Mark the files of the given job as recently used, so that the garbage
+    collector keeps them around."""
+
+    prefix = os.path.join(www.settings.RENDERING_RESULT_PATH,
+                          job.files_prefix())
+    for path in glob.glob(prefix + '*'):
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+    RenderingFile.objects.filter(job=job).update(mtime=time.time())
+
+def publish(job):
+    """Try to serve the given new, unsaved, job from the cache. On a hit, the
+    job is saved as rendered with the files of the cached rendering.
+
+    Returns True on a hit, False otherwise; the job, still unsaved, has to be
+    saved and queued then."""
+
+    key = get_key(job)
+    source = lookup(key)
+    if source is None:
+        return False
+
+    now = datetime.now()
+    job.status = 2
+    job.startofrendering_time = now
+    job.endofrendering_time = now
+    job.resultmsg = 'ok'
+    job.render_key = key
+    job.save()
+
+    try:
+        job.link_files(source)
+    except OSError, e:
+        l.warning("Could not reuse the rendering of job #%d for job #%d: %s" %
+                  (source.id, job.id, e))
+        prefix = os.path.join(www.settings.RENDERING_RESULT_PATH,
+                              job.files_prefix())
+        for path in glob.glob(prefix + '*'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+        # The job was only saved to get the ID its files are named after: it
+        # may still be refused, so it's saved again only once it's queued.
+        job.delete()
+        job.id = None
+        job.status = 0
+        job.startofrendering_time = None
+        job.endofrendering_time = None
+        job.resultmsg = None
+        job.render_key = None
+        return False
+
+    _touch(source)
+    l.info("Job #%d served from the rendering of job #%d." %
+           (job.id, source.id))
+    return True
@@ -25,17 +25,22 @@
 # Views for MapOSMatic
 
 import datetime
+import gzip
 import logging
+import os
 
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
+from django.db.models import Avg, Count, Max
 from django.core.urlresolvers import reverse
 from django.http import HttpResponseRedirect, HttpResponseBadRequest, HttpResponse
+from django.http import Http404
 from django.shortcuts import get_object_or_404, render_to_response
 from django.template import RequestContext
 from django.utils.translation import ugettext_lazy as _
 
 import ocitysmap
-from www.maposmatic import helpers, forms, nominatim, models
+from www.maposmatic import helpers, forms, nominatim, models, wakeup
+from www.maposmatic import admission, downloads, estimate, eta, rendercache
 import www.settings
 
 LOG = logging.getLogger('maposmatic')
@@ -78,6 +83,25 @@ def donate_thanks(request):
     return render_to_response('maposmatic/donate-thanks.html',
                               context_instance=RequestContext(request))
 
+def _refuse(request, refusal):
+    """Respond to the submission of a job refused by the admission control:
+    send the submitter to an identical job already queued if there's one, or
+    ask them to try again later."""
+
+    if refusal.existing:
+        request.session['redirected'] = True
+        return HttpResponseRedirect(reverse('map-by-id',
+                                            args=[refusal.existing.id]))
+
+    response = render_to_response('maposmatic/busy.html',
+                                  { 'reason': refusal.reason,
+                                    'retry_minutes':
+                                        refusal.retry_after / 60 + 1 },
+                                  context_instance=RequestContext(request))
+    response.status_code = refusal.reason == 'rate' and 429 or 503
+    response['Retry-After'] = str(refusal.retry_after)
+    return response
+
 def new(request):
     """The map creation page and form."""
 
@@ -96,7 +120,14 @@ def new(request):
             job.index_queue_at_submission = (models.MapRenderingJob.objects
                                              .queue_size())
             job.nonce = helpers.generate_nonce(models.MapRenderingJob.NONCE_SIZE)
-            job.save()
+            if not rendercache.publish(job):
+                refusal = admission.check(job, job.submitterip)
+                if refusal:
+                    return _refuse(request, refusal)
+
+                job.estimated_cost = estimate.estimate_cost(job)
+                job.save()
+                wakeup.notify()
 
             return HttpResponseRedirect(reverse('map-by-id-and-nonce',
                                                 args=[job.id, job.nonce]))
@@ -107,6 +138,37 @@ def new(request):
                               { 'form' : form },
                               context_instance=RequestContext(request))
 
+def _get_progress(job, estimates):
+    """Returns the progress of the given job, in percent: its rendering
+    progress when it's rendering, its progress in the queue otherwise."""
+
+    if job.is_rendering():
+        return job.progress_percent or 0
+
+    queue_size = estimates.queue_size
+    if not queue_size:
+        return 100
+    position = estimates.get_position(job)
+    return 20 + int(80 * (queue_size - position) / float(queue_size))
+
+def _get_refresh(job, estimates):
+    """Returns the number of seconds after which the status of the given job
+    should be checked again, or None when it won't change anymore. Jobs that
+    won't start rendering soon are checked less often."""
+
+    if job.is_rendering():
+        return www.settings.REFRESH_JOB_RENDERING
+    if not job.is_waiting():
+        return None
+
+    refresh = www.settings.REFRESH_JOB_WAITING
+    start = estimates.get_start(job)
+    if start:
+        wait = start - datetime.datetime.now()
+        refresh = max(refresh, min(www.settings.REFRESH_JOB_WAITING_MAX,
+                                   (wait.days * 86400 + wait.seconds) / 2))
+    return refresh
+
 def map_full(request, id, nonce=None):
     """The full-page map details page.
 
@@ -118,22 +180,77 @@ def map_full(request, id, nonce=None):
     isredirected = request.session.get('redirected', False)
     request.session.pop('redirected', None)
 
-    queue_size = models.MapRenderingJob.objects.queue_size()
-    progress = 100
-    if queue_size:
-        progress = 20 + int(80 * (queue_size -
-            job.current_position_in_queue()) / float(queue_size))
-
-    refresh = job.is_rendering() and \
-        www.settings.REFRESH_JOB_RENDERING or \
-        www.settings.REFRESH_JOB_WAITING
+    estimates = eta.get()
 
     return render_to_response('maposmatic/map-full.html',
                               { 'map': job, 'redirected': isredirected,
-                                'nonce': nonce, 'refresh': refresh,
-                                'progress': progress, 'queue_size': queue_size },
+                                'nonce': nonce,
+                                'refresh': _get_refresh(job, estimates),
+                                'progress': _get_progress(job, estimates),
+                                'queue_size': estimates.queue_size,
+                                'position': estimates.get_position(job),
+                                'estimated_start': estimates.get_start(job),
+                                'estimated_end': estimates.get_end(job) },
                               context_instance=RequestContext(request))
 
+def api_map_progress(request, id):
+    """The status and progress of a job, in JSON. Clients should wait for the
+    number of seconds given by 'refresh' before asking again, if not null."""
+
+    job = get_object_or_404(models.MapRenderingJob, id=id)
+    estimates = eta.get()
+
+    def format_time(t):
+        return t and t.isoformat() or None
+
+    contents = {'status': job.status,
+                'progress': _get_progress(job, estimates),
+                'refresh': _get_refresh(job, estimates)}
+    if job.is_waiting():
+        contents.update({
+            'position': estimates.get_position(job),
+            'queue_size': estimates.queue_size,
+            'estimated_start': format_time(estimates.get_start(job)),
+            'estimated_end': format_time(estimates.get_end(job))})
+    elif job.is_rendering():
+        contents.update({
+            'stage': job.progress_stage,
+            'done': job.progress_done,
+            'total': job.progress_total,
+            'estimated_end': format_time(estimates.get_end(job))})
+
+    response = HttpResponse(content=json_encode(contents),
+                            mimetype='text/json')
+    if contents['refresh']:
+        response['Cache-Control'] = 'max-age=%d' % min(contents['refresh'],
+                                                       10)
+    return response
+
+def map_download(request, id, format):
+    """Count a download of the output file of the given format of a job, and
+    redirect to the file itself."""
+
+    job = get_object_or_404(models.MapRenderingJob, id=id)
+    if format not in www.settings.RENDERING_RESULT_FORMATS:
+        raise Http404
+
+    path = job.get_map_filepath(format)
+    if format == 'csv':
+        path = job.get_index_filepath()
+    if not path or not os.path.exists(path):
+        raise Http404
+
+    downloads.record(job)
+
+    # Indexes gzipped in the cold tier are served uncompressed.
+    if path.endswith('.gz'):
+        f = gzip.open(path, 'rb')
+        try:
+            return HttpResponse(content=f.read(), mimetype='text/csv')
+        finally:
+            f.close()
+    return HttpResponseRedirect(job.get_map_fileurl(format))
+
 def maps(request):
     """Displays all maps and jobs, sorted by submission time, or maps matching
     the search terms when provided."""
@@ -174,6 +291,28 @@ def maps(request):
                               context_instance=RequestContext(request))
 
 
+def stats(request):
+    """Rendering statistics: the average and maximum time spent in each
+    rendering stage, by layout, over the last STATS_PERIOD_DAYS days."""
+
+    since = (datetime.datetime.now() -
+             datetime.timedelta(www.settings.STATS_PERIOD_DAYS))
+    timings = (models.MapRenderingJobTiming.objects
+               .filter(job__endofrendering_time__gte=since)
+               .values('job__layout', 'stage')
+               .annotate(count=Count('id'), average=Avg('duration'),
+                         maximum=Max('duration'))
+               .order_by('job__layout', 'stage'))
+
+    layouts = {}
+    for timing in timings:
+        layouts.setdefault(timing['job__layout'], []).append(timing)
+
+    return render_to_response('maposmatic/stats.html',
+                              { 'layouts': sorted(layouts.items()),
+                                'days': www.settings.STATS_PERIOD_DAYS },
+                              context_instance=RequestContext(request))
+
 def recreate(request):
     if request.method == 'POST':
         form = forms.MapRecreateForm(request.POST)
@@ -203,7 +342,14 @@ def recreate(request):
             newjob.index_queue_at_submission = (models.MapRenderingJob.objects
                                                .queue_size())
             newjob.nonce = helpers.generate_nonce(models.MapRenderingJob.NONCE_SIZE)
-            newjob.save()
+            if not rendercache.publish(newjob):
+                refusal = admission.check(newjob, newjob.submitterip)
+                if refusal:
+                    return _refuse(request, refusal)
+
+                newjob.estimated_cost = estimate.estimate_cost(newjob)
+                newjob.save()
+                wakeup.notify()
 
             return HttpResponseRedirect(reverse('map-by-id-and-nonce',
                                                 args=[newjob.id, newjob.nonce]))
@@ -0,0 +1,151 @@
+# coding: utf-8
+
+# maposmatic, the web front-end of the MapOSMatic city map generation system
+# Copyright (C) 2009  David Decotigny
+# Copyright (C) 2009  Frédéric Lehobey
+# Copyright (C) 2009  David Mentré
+# Copyright (C) 2009  Maxime Petazzoni
+# Copyright (C) 2009  Thomas Petazzoni
+# Copyright (C) 2009  Gaël Utard
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Rendering daemon wakeup notifications. The web front-end calls notify() when
+# it queues a job, and the rendering daemon blocks on a Listener until it gets
+# notified, instead of polling the database for new jobs. With PostgreSQL, the
+# notifications go through LISTEN/NOTIFY; with other databases (SQLite), they
+# are sent as datagrams to the DAEMON_WAKEUP_SOCKET UNIX socket.
+
+import errno
+import logging
+import os
+import select
+import socket
+import time
+
+from django.db import connection, transaction
+import www.settings
+
+l = logging.getLogger('maposmatic')
+
+CHANNEL = 'maposmatic_jobs'
+
+def _use_postgresql():
+    return 'postgresql' in www.settings.DATABASES['default']['ENGINE']
+
+def notify():
+    """Wake the rendering daemon up. Failures are only logged: a missed
+    notification just delays the job until the daemon's next poll."""
+
+    try:
+        if _use_postgresql():
+            cursor = connection.cursor()
+            cursor.execute('NOTIFY %s' % CHANNEL)
+            transaction.commit_unless_managed()
+            return
+
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            s.setblocking(0)
+            s.sendto('wakeup', www.settings.DAEMON_WAKEUP_SOCKET)
+        finally:
+            s.close()
+    except (socket.error, EnvironmentError), e:
+        # The daemon is not running or not listening.
+        l.debug("Could not wake the rendering daemon up: %s" % e)
+    except Exception, e:
+        l.warning("Could not wake the rendering daemon up: %s" % e)
+
+class Listener:
+    """
+    Receives the wakeup notifications sent by notify(). Not thread-safe, only
+    one thread should wait() on a given listener.
+    """
+
+    def __init__(self):
+        self.__conn = None
+        self.__socket = None
+
+    def __open(self):
+        if _use_postgresql():
+            import psycopg2
+            import psycopg2.extensions
+
+            db = www.settings.DATABASES['default']
+            self.__conn = psycopg2.connect(database=db['NAME'],
+                                           user=db['USER'],
+                                           password=db['PASSWORD'],
+                                           host=db['HOST'] or None,
+                                           port=db['PORT'] or None)
+            self.__conn.set_isolation_level(
+                psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            self.__conn.cursor().execute('LISTEN %s' % CHANNEL)
+            l.info("Listening for new jobs on the %s channel." % CHANNEL)
+        else:
+            path = www.settings.DAEMON_WAKEUP_SOCKET
+            if os.path.exists(path):
+                os.remove(path)
+            self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.__socket.bind(path)
+            # The web front-end usually runs as a different user.
+            os.chmod(path, 0666)
+            l.info("Listening for new jobs on %s." % path)
+
+    def fileno(self):
+        if self.__conn:
+            return self.__conn.fileno()
+        return self.__socket.fileno()
+
+    def wait(self, timeout):
+        """Wait for a wakeup notification for at most timeout seconds.
+
+        Returns True if a notification was received, False otherwise."""
+
+        try:
+            if not self.__conn and not self.__socket:
+                self.__open()
+
+            ready, _, _ = select.select([self], [], [], timeout)
+            if not ready:
+                return False
+
+            if self.__conn:
+                self.__conn.poll()
+                notified = len(self.__conn.notifies) > 0
+                del self.__conn.notifies[:]
+                return notified
+
+            # Drain all pending notifications at once.
+            while True:
+                try:
+                    self.__socket.recv(64, socket.MSG_DONTWAIT)
+                except socket.error, e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        return True
+                    raise
+        except Exception, e:
+            if isinstance(e, select.error) and e.args[0] == errno.EINTR:
+                return False
+            l.warning("Wakeup notifications unavailable (%s), will retry." % e)
+            self.close()
+            time.sleep(timeout)
+            return False
+
+    def close(self):
+        if self.__conn:
+            self.__conn.close()
+        if self.__socket:
+            self.__socket.close()
+        self.__conn = None
+        self.__socket = None
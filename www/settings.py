@@ -270,6 +270,18 @@ def has_gis_database():
 REFRESH_JOB_WAITING = 30
 REFRESH_JOB_RENDERING = 15
 
+# Waiting jobs are checked again after half the time left before their
+# estimated rendering start, between REFRESH_JOB_WAITING and this many seconds.
+REFRESH_JOB_WAITING_MAX = 300
+
+# The download counts of the rendered maps are kept in memory by each web
+# front-end process, and written to the database at most every this many
+# seconds.
+DOWNLOADS_FLUSH_INTERVAL = 60
+
+# Number of days of rendered jobs accounted for in the rendering statistics.
+STATS_PERIOD_DAYS = 30
+
 def is_daemon_running():
     return os.path.exists(MAPOSMATIC_PID_FILE)
 
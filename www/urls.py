@@ -57,10 +57,19 @@ urlpatterns = patterns('',
     url(r'^maps/$',
         maposmatic.views.maps,
         name='maps'),
+    url(r'^maps/(?P<id>\d+)/progress$',
+        maposmatic.views.api_map_progress,
+        name='map-progress'),
+    url(r'^maps/(?P<id>\d+)/download/(?P<format>[a-z]+)$',
+        maposmatic.views.map_download,
+        name='map-download'),
 
     url(r'^about/$',
         maposmatic.views.about,
         name='about'),
+    url(r'^stats/$',
+        maposmatic.views.stats,
+        name='stats'),
     url(r'^donate/$',
         maposmatic.views.donate,
         name='donate'),